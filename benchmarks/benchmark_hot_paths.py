@@ -0,0 +1,210 @@
+# Time the Python hot paths of the dynamic speed scripts on synthetic scenes and subtitles (no video file is needed)
+# and save the results in a json file, files saved at different commits can be compared with --compare
+# the chunked audio stretch of --stream-audio is timed with 1 and with --stretch-workers processes on a synthetic wav (needs ffmpeg)
+# usage: python benchmarks/benchmark_hot_paths.py [-c CUTS] [-se SUBTITLE_EVENTS] [-ss STRETCH_SECONDS] [-sw STRETCH_WORKERS] [-r REPEAT] [-o OUTPUT] [-cmp COMPARE] [-ff FFMPEG]
+
+import argparse
+import ast
+import contextlib
+import datetime
+import io
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+AUDIO_SCRIPT_PATH = os.path.join(REPOSITORY_FOLDER, 'video-audio-track-sync-scenes-dynamic-speed', 'video_audio_track_sync_scenes_dynamic_speed.py')
+# bumped when the content of the results changes, results of other versions are not compared
+BENCHMARK_RESULTS_VERSION = 1
+
+sys.path.append(os.path.join(REPOSITORY_FOLDER, 'common'))
+from frame_store import *
+from scene_capture import *
+from subtitles import *
+from time_stretch import *
+
+# Functions of a script without running it: only its imports and its top level functions are executed
+def load_script_functions(script_path):
+    with open(script_path, 'r') as script_file:
+        tree = ast.parse(script_file.read(), script_path)
+    def is_import(node):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            return True
+        # the imports of the PyInstaller bundle or of the normal Python environment
+        return isinstance(node, ast.If) and all(is_import(child) for child in node.body + node.orelse)
+    tree.body = [node for node in tree.body if is_import(node) or isinstance(node, ast.FunctionDef)]
+    namespace = {'__file__': script_path, '__name__': 'benchmarked_script', 'batch_mode': False}
+    exec(compile(tree, script_path, 'exec'), namespace)
+    return namespace
+
+def git_commit():
+    try:
+        return subprocess.run('git rev-parse --short HEAD', shell=True, cwd=REPOSITORY_FOLDER, capture_output=True, text=True).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+# Frame stores of the source and target scenes: the target has every source scene (hash with a few flipped bits) plus
+# some extra ones and plays 4% slower, like a 25 fps source synced on a 24 fps target
+def build_scene_stores(random, cut_count):
+    target_count = int(cut_count * 1.2)
+    target_bits = random.random((target_count, 64)) > 0.5
+    source_positions = np.sort(random.choice(target_count, size=cut_count, replace=False))
+    source_bits = target_bits[source_positions] ^ (random.random((cut_count, 64)) > 0.95)
+    target_times = np.cumsum(random.uniform(0.5, 5, target_count))
+    source_times = target_times[source_positions] / 1.04
+    def build_store(bits, times, video_fps):
+        pts = np.round(times * 90000).astype(np.int64)
+        hashes = np.packbits(bits, axis=1).view('>u8')[:, 0].astype(np.uint64)
+        return build_frame_store(np.arange(len(pts)), pts, pts / 90000, hashes, np.ones(len(pts), dtype=np.bool_), 90000, video_fps, 90000 / video_fps, 48000 / video_fps)
+    return build_store(source_bits, source_times, 25), build_store(target_bits, target_times, 24)
+
+# time.txt written by ffmpeg metadata=print for the scenes of a frame store
+def write_time_file(output_folder, frame_store):
+    with open(os.path.join(output_folder, 'time.txt'), 'w') as time_file:
+        for frame_info in frame_store:
+            time_file.write(f"frame:{frame_info['scene_frame_index']} pts:{frame_info['pts']} pts_time:{frame_info['pts_time']:.6f}\n")
+            time_file.write(f"lavfi.scene_score=0.{frame_info['scene_frame_index'] % 1000:03d}\n")
+
+def write_subtitle_file(subtitle_path, random, event_count):
+    starts = np.cumsum(random.uniform(500, 3000, event_count)).astype(np.int64)
+    ends = starts + random.integers(300, 2500, event_count)
+    def srt_time(ms):
+        return "{:02d}:{:02d}:{:02d},{:03d}".format(ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+    with open(subtitle_path, 'w') as subtitle_file:
+        for index, (start, end) in enumerate(zip(starts, ends)):
+            subtitle_file.write(f"{index + 1}\n{srt_time(int(start))} --> {srt_time(int(end))}\nline {index + 1}\n\n")
+    return int(ends[-1])
+
+# Stereo noise wav and the timecodes of a target 4% slower with an anchor every 10 seconds, returns the output length
+def write_stretch_audio(audio_path, random, seconds, sample_rate=48000):
+    samples = (np.clip(random.standard_normal((seconds * sample_rate, 2)) * 0.1, -1, 1) * 32767).astype(np.int16)
+    with wave.open(audio_path, 'wb') as audio_file:
+        audio_file.setnchannels(2)
+        audio_file.setsampwidth(2)
+        audio_file.setframerate(sample_rate)
+        audio_file.writeframes(samples.tobytes())
+    timecodes = [[second * sample_rate, int(round(second * sample_rate * 1.04))] for second in range(0, seconds + 1, 10)]
+    return timecodes, int(round(seconds * sample_rate * 1.04))
+
+# Best and median seconds of repeat calls, what the function prints is not timed on the console
+def time_function(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+    return {"best_seconds": min(seconds), "median_seconds": float(np.median(seconds))}
+
+parser = argparse.ArgumentParser(description='Benchmark of the Python hot paths of the dynamic speed scripts on synthetic data')
+
+parser.add_argument("-c", "--cuts", help="numbers of source scene cuts, comma separated (the target has 20%% more)", default="1000,5000,20000")
+parser.add_argument("-se", "--subtitle-events", help="number of lines of the synthetic subtitle file", type=int, default=5000)
+parser.add_argument("-ss", "--stretch-seconds", help="length of the synthetic audio stretched in chunks (0 to skip the stretch benchmark)", type=int, default=240)
+parser.add_argument("-sw", "--stretch-workers", help="processes of the parallel stretch, compared with a single one (default: one per cpu core)", type=int, default=os.cpu_count() or 1)
+parser.add_argument("-r", "--repeat", help="runs of every function, the best and the median time are kept", type=int, default=5)
+parser.add_argument("-s", "--seed", help="random seed", type=int, default=0)
+parser.add_argument("-o", "--output", help="json file where the results are saved (default: benchmarks/results/<commit>.json, disabled if 'none')", default="")
+parser.add_argument("-cmp", "--compare", help="json file saved by a previous run (ex: at another commit), the times are compared", default="")
+parser.add_argument("-ff", "--ffmpeg", help="path to ffmpeg executable", default="ffmpeg")
+
+ARGS = parser.parse_args()
+
+script = load_script_functions(AUDIO_SCRIPT_PATH)
+cut_counts = [int(cut_count) for cut_count in ARGS.cuts.split(',')]
+
+results = {}
+with tempfile.TemporaryDirectory() as work_folder:
+    for cut_count in cut_counts:
+        # same data for a scene count whatever the other counts are, results of runs with different --cuts can be compared
+        source_store, target_store = build_scene_stores(np.random.default_rng([ARGS.seed, cut_count]), cut_count)
+        known_hashes = {int(frame_info['scene_frame_index']): None for frame_info in source_store}
+        write_time_file(work_folder, source_store)
+        pairs = find_twin_frames(source_store, target_store, time_window=60)
+        pair_timecodes = script['frame_index_to_timecodes'](pairs, source_store, target_store, 25, 24, 48000 / 25)
+        source_duration = float(source_store[-1]['pts_s']) + 10
+
+        benchmarks = {
+            'read_frame_info': lambda: read_frame_info(work_folder, known_hashes, 90000, 25, 90000 / 25, 48000 / 25),
+            'find_twin_frames': lambda: find_twin_frames(source_store, target_store),
+            'find_twin_frames_time_window': lambda: find_twin_frames(source_store, target_store, time_window=60),
+            'find_twin_frames_dp': lambda: find_twin_frames(source_store, target_store, alignment='dp', alignment_band=200),
+            'frame_index_to_timecodes': lambda: script['frame_index_to_timecodes'](pairs, source_store, target_store, 25, 24, 48000 / 25),
+            'complete_timecodes': lambda: script['complete_timecodes'](pair_timecodes, source_duration, 48000),
+        }
+        for name, function in benchmarks.items():
+            key = f"{name}[{cut_count}]"
+            results[key] = dict(time_function(function, ARGS.repeat), size=cut_count)
+            print(f"{key:<40} {results[key]['best_seconds']:.4f}s (median {results[key]['median_seconds']:.4f}s)")
+
+    # retiming of a subtitle file with the pairs of the biggest scene count, milliseconds like the subs script
+    subtitle_path = os.path.join(work_folder, 'events.srt')
+    random = np.random.default_rng([ARGS.seed, ARGS.subtitle_events])
+    subtitle_duration = write_subtitle_file(subtitle_path, random, ARGS.subtitle_events)
+    subtitle_pairs = [[source_store[pair['main']]['pts_ms'], target_store[pair['twin']]['pts_ms']] for pair in pairs]
+    retime_table = build_retime_table(complete_subtitle_timecodes(subtitle_pairs, subtitle_duration / 1000))
+    times_ms = random.integers(0, subtitle_duration, ARGS.subtitle_events * 2)
+    benchmarks = {
+        'retime_milliseconds': lambda: retime_milliseconds(retime_table, times_ms),
+        'process_subtitles': lambda: process_subtitles(subtitle_path, subtitle_path + '.srt', retime_table),
+    }
+    for name, function in benchmarks.items():
+        key = f"{name}[{ARGS.subtitle_events}]"
+        results[key] = dict(time_function(function, ARGS.repeat), size=ARGS.subtitle_events)
+        print(f"{key:<40} {results[key]['best_seconds']:.4f}s (median {results[key]['median_seconds']:.4f}s)")
+
+    # chunks of the same audio stretched by one process and by --stretch-workers processes, the speedup is their ratio
+    if ARGS.stretch_seconds:
+        audio_path = os.path.join(work_folder, 'stretch.wav')
+        timecodes, output_samples = write_stretch_audio(audio_path, np.random.default_rng([ARGS.seed, ARGS.stretch_seconds]), ARGS.stretch_seconds)
+        source_knots, target_knots = build_time_map(timecodes)
+        for workers in sorted({1, ARGS.stretch_workers}):
+            stretch_pool = stretch_process_pool(workers)
+            key = f"stretch_chunks_{workers}_workers[{ARGS.stretch_seconds}]"
+            results[key] = dict(time_function(lambda: sum(len(block) for block in stretch_chunks(ARGS.ffmpeg, audio_path, 48000, 2, source_knots, target_knots, output_samples, workers, executor=stretch_pool)), ARGS.repeat), size=ARGS.stretch_seconds)
+            stretch_pool.shutdown()
+            print(f"{key:<40} {results[key]['best_seconds']:.4f}s (median {results[key]['median_seconds']:.4f}s)")
+        if ARGS.stretch_workers > 1:
+            single_seconds = results[f"stretch_chunks_1_workers[{ARGS.stretch_seconds}]"]['best_seconds']
+            parallel_seconds = results[f"stretch_chunks_{ARGS.stretch_workers}_workers[{ARGS.stretch_seconds}]"]['best_seconds']
+            print(f"{'stretch_chunks speedup':<40} x{single_seconds / max(parallel_seconds, 1e-9):.2f} with {ARGS.stretch_workers} workers")
+
+commit = git_commit()
+report = {
+    "version": BENCHMARK_RESULTS_VERSION,
+    "commit": commit,
+    "date": datetime.datetime.now().isoformat(timespec='seconds'),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "machine": platform.machine(),
+    "seed": ARGS.seed,
+    "repeat": ARGS.repeat,
+    "results": results
+}
+
+output_path = ARGS.output or os.path.join(BENCHMARKS_FOLDER, 'results', f"{commit}.json")
+if output_path != 'none':
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results saved in '{output_path}'")
+
+if ARGS.compare:
+    with open(ARGS.compare, 'r') as compare_file:
+        previous_report = json.load(compare_file)
+    if previous_report.get('version') != BENCHMARK_RESULTS_VERSION:
+        sys.exit(f"The results in '{ARGS.compare}' have version {previous_report.get('version')} (expected {BENCHMARK_RESULTS_VERSION})")
+    print(f"Compared with {previous_report['commit']} ({previous_report['date']}), best times:")
+    for key, result in results.items():
+        if key not in previous_report['results']:
+            print(f"{key:<40} new")
+            continue
+        previous_seconds = previous_report['results'][key]['best_seconds']
+        print(f"{key:<40} {previous_seconds:.4f}s -> {result['best_seconds']:.4f}s (speedup x{previous_seconds / max(result['best_seconds'], 1e-9):.2f})")
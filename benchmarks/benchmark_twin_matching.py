@@ -0,0 +1,70 @@
+# Compare the vectorized twin matching, the time windowed search and the dp alignment with the one ImageHash subtraction
+# per pair loop on synthetic hashes
+# usage: python benchmarks/benchmark_twin_matching.py [-mc MAIN_COUNT] [-bc BROTHER_COUNT]
+
+import argparse
+import imagehash
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+from twin_matching import *
+
+def build_frame_infos(hash_bits, times):
+    return [{'scene_frame_index': index, 'pts_s': time, 'hash': imagehash.ImageHash(bits.reshape(8, 8))} for index, (bits, time) in enumerate(zip(hash_bits, times))]
+
+parser = argparse.ArgumentParser(description='Benchmark of find_nearest_hashes against the pure python loop')
+
+parser.add_argument("-mc", "--main-count", help="number of main scene frames", type=int, default=1000)
+parser.add_argument("-bc", "--brother-count", help="number of brother scene frames", type=int, default=1200)
+parser.add_argument("-tw", "--time-window", help="seconds of the window used by the time windowed search", type=float, default=60)
+parser.add_argument("-s", "--seed", help="random seed", type=int, default=0)
+
+ARGS = parser.parse_args()
+
+random = np.random.default_rng(ARGS.seed)
+
+# brothers are the main frames with a few flipped bits plus some extra scenes
+brother_bits = random.random((ARGS.brother_count, 64)) > 0.5
+main_positions = np.sort(random.choice(ARGS.brother_count, size=min(ARGS.main_count, ARGS.brother_count), replace=False))
+main_bits = brother_bits[main_positions] ^ (random.random((len(main_positions), 64)) > 0.95)
+
+# a scene every few seconds, the main side plays 4% faster
+brother_times = np.cumsum(random.uniform(0.5, 5, ARGS.brother_count))
+main_times = brother_times[main_positions] / 1.04
+
+main_frame_infos = build_frame_infos(main_bits, main_times)
+brothers_frame_infos = build_frame_infos(brother_bits, brother_times)
+
+start = time.perf_counter()
+loop_positions, loop_distances = find_nearest_hashes_loop(main_frame_infos, brothers_frame_infos)
+loop_seconds = time.perf_counter() - start
+
+start = time.perf_counter()
+main_hashes = pack_hashes(main_frame_infos)
+brother_hashes = pack_hashes(brothers_frame_infos)
+vectorized_positions, vectorized_distances = find_nearest_hashes(main_hashes, brother_hashes)
+vectorized_seconds = time.perf_counter() - start
+
+start = time.perf_counter()
+windowed_positions, windowed_distances = find_nearest_hashes_in_time(main_times, main_hashes, brother_times, brother_hashes, ARGS.time_window)
+windowed_seconds = time.perf_counter() - start
+
+start = time.perf_counter()
+aligned = align_hashes_monotonic(main_hashes, brother_hashes)
+aligned_seconds = time.perf_counter() - start
+
+identical = list(vectorized_positions) == loop_positions and list(vectorized_distances) == list(loop_distances)
+windowed_matching = np.mean(windowed_positions == main_positions) * 100
+aligned_matching = sum(brother_position == main_positions[main_position] for main_position, brother_position, distance in aligned) / len(main_positions) * 100
+
+print(f"{len(main_frame_infos)} x {len(brothers_frame_infos)} scene frames")
+print(f"loop:         {loop_seconds:.3f}s")
+print(f"vectorized:   {vectorized_seconds:.3f}s (x{loop_seconds / vectorized_seconds:.0f})")
+print(f"time window:  {windowed_seconds:.3f}s (x{loop_seconds / windowed_seconds:.0f}, {windowed_matching:.1f}% right twins)")
+print(f"dp alignment: {aligned_seconds:.3f}s (x{loop_seconds / aligned_seconds:.0f}, {aligned_matching:.1f}% right twins)")
+print(f"identical pairs: {identical}")
+
+sys.exit(0 if identical else 1)
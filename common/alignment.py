@@ -0,0 +1,75 @@
+import json
+import numpy as np
+import os
+import sys
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.frame_store import *
+    from common.frame_cache import partial_content_hash
+else:
+    # The application is running in a normal Python environment
+    from frame_store import *
+    from frame_cache import partial_content_hash
+
+# bumped when the content of the file changes, files of other versions are refused
+ALIGNMENT_VERSION = 2
+
+# Rows of a frame store without the fields depending on the audio, hashes as hex strings
+def alignment_scenes(frame_infos):
+    scenes = []
+    for frame_info in frame_infos:
+        scenes.append({
+            "scene_frame_index": int(frame_info['scene_frame_index']),
+            "index": int(frame_info['index']),
+            "second_index": int(frame_info['second_index']),
+            "pts": int(frame_info['pts']),
+            "pts_s": float(frame_info['pts_s']),
+            "pts_time": float(frame_info['pts_time']),
+            "hash": frame_hash_string(frame_info)
+        })
+    return scenes
+
+# Same frame store returned by capture_frame_info, audio samples are computed for the given frequency
+def alignment_frame_infos(scenes, audio_hz=0):
+    frame_infos = np.zeros(len(scenes), dtype=FRAME_STORE_DTYPE)
+    for name in ('scene_frame_index', 'index', 'second_index', 'pts', 'pts_s', 'pts_time'):
+        frame_infos[name] = [scene[name] for scene in scenes]
+    frame_infos['pts_ms'] = frame_infos['pts_s'] * 1000
+    frame_infos['audio_sample'] = frame_infos['pts_s'] * audio_hz
+    frame_infos['hashed'] = [scene['hash'] is not None for scene in scenes]
+    frame_infos['hash'] = [int(scene['hash'], 16) if scene['hash'] is not None else 0 for scene in scenes]
+    return frame_infos
+
+def alignment_video(video_path, frame_infos):
+    return {"path": os.path.abspath(video_path), "size": os.path.getsize(video_path), "content": partial_content_hash(video_path), "scenes": alignment_scenes(frame_infos)}
+
+# True if the alignment side has been made from this video (same size and content, the path can change)
+def alignment_video_matches(video_alignment, video_path):
+    return os.path.getsize(video_path) == video_alignment['size'] and partial_content_hash(video_path) == video_alignment['content']
+
+# Scenes, pairs and time map of a run, shared by the audio and subtitle scripts
+# time_map has the [source second, target second] of every pair (removed_pairs are indexes of both lists), the scripts
+# loading the file build their timecodes from it for any sample rate
+def save_alignment(alignment_path, source_path, target_path, source_frame_infos, target_frame_infos, pairs, removed_pair_indexes, source_anchors, target_anchors):
+    alignment = {
+        "version": ALIGNMENT_VERSION,
+        "source": alignment_video(source_path, source_frame_infos),
+        "target": alignment_video(target_path, target_frame_infos),
+        "source_anchors": [int(anchor) for anchor in source_anchors],
+        "target_anchors": [int(anchor) for anchor in target_anchors],
+        "pairs": [{"main": int(pair['main']), "twin": int(pair['twin']), "distance": int(pair['distance'])} for pair in pairs],
+        "removed_pairs": sorted(removed_pair_indexes),
+        "time_map": [[float(source_frame_infos[pair['main']]['pts_s']), float(target_frame_infos[pair['twin']]['pts_s'])] for pair in pairs]
+    }
+    # written to a temporary file first, an interrupted run never leaves a broken alignment
+    with open(alignment_path + '.tmp', 'w') as alignment_file:
+        json.dump(alignment, alignment_file)
+    os.replace(alignment_path + '.tmp', alignment_path)
+
+def load_alignment(alignment_path):
+    with open(alignment_path, 'r') as alignment_file:
+        alignment = json.load(alignment_file)
+    if alignment.get('version') != ALIGNMENT_VERSION:
+        raise ValueError(f"Alignment file version {alignment.get('version')} is not supported (expected {ALIGNMENT_VERSION})")
+    return alignment
@@ -0,0 +1,150 @@
+import numpy as np
+import sys
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+
+# sample rate of the decoded audio, enough for the onsets of the music and the effects shared by source and target
+AUDIO_ALIGNMENT_HZ = 8000
+# samples of every spectrum and distance between two of them: the onset envelope has 100 values per second
+ONSET_FRAME_SAMPLES = 512
+ONSET_HOP_SAMPLES = 80
+ONSET_HZ = AUDIO_ALIGNMENT_HZ / ONSET_HOP_SAMPLES
+# spectra computed at the same time, keeps memory bounded on long videos
+ONSET_BLOCK_FRAMES = 4096
+# seconds of the moving average removed from the envelope, only the onsets are left
+ONSET_AVERAGE_SECONDS = 1
+# source/target speed ratios tried before matching the windows: same speed and the usual frame rate conversions
+# (23.976 and 24 fps films sped up to 25 fps and back)
+AUDIO_ALIGNMENT_SPEEDS = (1, 25 / 23.976, 23.976 / 25, 25 / 24, 24 / 25, 24 / 23.976, 23.976 / 24)
+
+def spectral_flux(stream):
+    # Onset envelope of mono float32 samples read from the pipe: the sum of the increases of the log spectrum at every hop
+    window = np.hanning(ONSET_FRAME_SAMPLES).astype(np.float32)
+    block_bytes = (ONSET_BLOCK_FRAMES * ONSET_HOP_SAMPLES) * 4
+    pending = np.zeros(0, dtype=np.float32)
+    previous_spectrum = None
+    envelopes = []
+    while True:
+        data = stream.read(block_bytes)
+        if data:
+            # an odd byte count only happens at the end of the pipe
+            pending = np.concatenate((pending, np.frombuffer(data[:len(data) // 4 * 4], dtype=np.float32)))
+        frame_count = (len(pending) - ONSET_FRAME_SAMPLES) // ONSET_HOP_SAMPLES + 1 if len(pending) >= ONSET_FRAME_SAMPLES else 0
+        if frame_count > 0:
+            frames = np.lib.stride_tricks.sliding_window_view(pending, ONSET_FRAME_SAMPLES)[::ONSET_HOP_SAMPLES][:frame_count]
+            spectrum = np.log1p(100 * np.abs(np.fft.rfft(frames * window, axis=1))).astype(np.float32)
+            previous = spectrum[:1] if previous_spectrum is None else previous_spectrum
+            flux = np.diff(np.concatenate((previous, spectrum)), axis=0)
+            envelopes.append(np.maximum(flux, 0).sum(axis=1))
+            previous_spectrum = spectrum[-1:]
+            # the next frame starts right after the hops already used
+            pending = pending[frame_count * ONSET_HOP_SAMPLES:]
+        if not data:
+            break
+    return np.concatenate(envelopes) if envelopes else np.zeros(0, dtype=np.float32)
+
+# Onset envelope (ONSET_HZ values per second) of an audio stream of video_path, no video frame is decoded
+def extract_onset_envelope(video_path, ffmpeg_script, progress_label, video_duration=None, audio_stream=0):
+    ffmpeg_cmd = (
+        f"{ffmpeg_script} -loglevel quiet {FFMPEG_STDERR_PROGRESS_ARGS} -i \"{video_path}\" "
+        f"-map 0:a:{audio_stream} -vn -ac 1 -ar {AUDIO_ALIGNMENT_HZ} -f f32le pipe:1"
+    )
+    envelope = {}
+    run_ffmpeg_with_progress(ffmpeg_cmd, progress_label, video_duration, stdout_reader=lambda stream: envelope.update(values=spectral_flux(stream)))
+    values = envelope['values'].astype(np.float64)
+    if len(values) == 0:
+        return values
+    average_size = int(ONSET_AVERAGE_SECONDS * ONSET_HZ)
+    average = np.convolve(values, np.ones(average_size) / average_size, mode='same')
+    return values - average
+
+def resample_envelope(envelope, speed):
+    # envelope of a video played speed times faster, so that the source envelope follows the target timeline
+    if speed == 1:
+        return envelope
+    positions = np.arange(0, len(envelope) - 1, speed)
+    return np.interp(positions, np.arange(len(envelope)), envelope)
+
+def normalized_cross_correlation(region, template):
+    # Pearson correlation of template with every part of region of the same length, computed with a single FFT product
+    size = len(template)
+    template = (template - template.mean()) / template.std()
+    fft_size = 1 << int(np.ceil(np.log2(len(region) + size)))
+    products = np.fft.irfft(np.fft.rfft(region, fft_size) * np.conj(np.fft.rfft(template, fft_size)), fft_size)[:len(region) - size + 1]
+    sums = np.concatenate(([0], np.cumsum(region)))
+    squares = np.concatenate(([0], np.cumsum(region * region)))
+    region_sums = sums[size:] - sums[:-size]
+    region_squares = squares[size:] - squares[:-size]
+    region_std = np.sqrt(np.maximum(region_squares / size - (region_sums / size) ** 2, 1e-12))
+    return products / (size * region_std)
+
+# Speed ratio and lag (in envelope values of the resampled source) with the highest correlation of the whole envelopes
+def estimate_speed_and_lag(source_envelope, target_envelope):
+    best = None
+    for speed in AUDIO_ALIGNMENT_SPEEDS:
+        source = resample_envelope(source_envelope, speed)
+        fft_size = 1 << int(np.ceil(np.log2(len(source) + len(target_envelope))))
+        products = np.fft.irfft(np.fft.rfft(source, fft_size) * np.conj(np.fft.rfft(target_envelope, fft_size)), fft_size)
+        # lags are circular: the negative ones are at the end
+        lag = int(np.argmax(products))
+        score = products[lag] / (np.linalg.norm(source) * np.linalg.norm(target_envelope) or 1)
+        if lag > fft_size // 2:
+            lag -= fft_size
+        if best is None or score > best[2]:
+            best = (speed, lag, score)
+    return best
+
+# [source second, target second, correlation] pairs found matching every window of the target envelope with the source one
+# every window is searched max_offset_seconds around the offset of the previous matched window, so that the piecewise
+# offsets of cut or added scenes are followed; windows correlating less than min_correlation (dialogue, silence) are skipped
+def match_envelope_windows(source_envelope, target_envelope, speed, lag, window_seconds, max_offset_seconds, min_correlation):
+    source = resample_envelope(source_envelope, speed)
+    window = int(window_seconds * ONSET_HZ)
+    max_offset = int(max_offset_seconds * ONSET_HZ)
+    pairs = []
+    for start in range(0, len(target_envelope) - window + 1, window // 2):
+        template = target_envelope[start:start + window]
+        if template.std() == 0:
+            continue
+        region_start = max(start + lag - max_offset, 0)
+        region = source[region_start:start + lag + window + max_offset]
+        if len(region) < window:
+            continue
+        correlation = normalized_cross_correlation(region, template)
+        best = int(np.argmax(correlation))
+        if correlation[best] < min_correlation:
+            continue
+        window_lag = region_start + best - start
+        middle = start + window / 2
+        source_second = (middle + window_lag) * speed / ONSET_HZ
+        # the source has to move forward, a window matched before the previous one is a repeated sound
+        if pairs and source_second <= pairs[-1][0]:
+            continue
+        pairs.append([source_second, middle / ONSET_HZ, float(correlation[best])])
+        lag = window_lag
+    return pairs
+
+# Alignment of two videos from their audio only: piecewise [source second, target second, correlation] pairs,
+# the same kind of time map found with the scenes
+def find_audio_alignment(source_path, target_path, ffmpeg_script, source_duration=None, target_duration=None, window_seconds=20, max_offset_seconds=60, min_correlation=0.3, source_audio_stream=0, target_audio_stream=0):
+    source_envelope, target_envelope = run_parallel(extract_onset_envelope, [
+        dict(video_path=source_path, ffmpeg_script=ffmpeg_script, progress_label='source audio', video_duration=source_duration, audio_stream=source_audio_stream),
+        dict(video_path=target_path, ffmpeg_script=ffmpeg_script, progress_label='target audio', video_duration=target_duration, audio_stream=target_audio_stream)
+    ], max_workers=2)
+    if len(source_envelope) == 0 or len(target_envelope) == 0:
+        return []
+    speed, lag, score = estimate_speed_and_lag(source_envelope, target_envelope)
+    print(f"Audio alignment: {speed:.4f} source seconds per target second, offset {lag * speed / ONSET_HZ:.2f}s (correlation {score:.2f})")
+    return match_envelope_windows(source_envelope, target_envelope, speed, lag, window_seconds, max_offset_seconds, min_correlation)
+
+def describe_audio_pairs(pairs):
+    # one line per pair with its index, to choose the pairs to remove
+    for index, (source_second, target_second, correlation) in enumerate(pairs):
+        source_time = "{:02d}:{:02d}:{:06.3f}".format(int(source_second // 3600), int(source_second % 3600 // 60), source_second % 60)
+        target_time = "{:02d}:{:02d}:{:06.3f}".format(int(target_second // 3600), int(target_second % 3600 // 60), target_second % 60)
+        print(f"Association index {index}: source {source_time} --> target {target_time} (correlation {correlation:.2f})")
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import time
+
+# Increase it when the content of a cache entry changes
+FRAME_CACHE_VERSION = 2
+FRAME_CACHE_CHUNK_SIZE = 1024 * 1024
+# score vector kept in the frame folder when there is no cache dir (see load_folder_scores)
+FOLDER_SCORES_FILE = 'scores.npz'
+
+def partial_content_hash(video_path):
+    # Hash of the beginning, middle and end of the file: reading a whole video would cost as much as decoding it
+    size = os.path.getsize(video_path)
+    sha1 = hashlib.sha1(str(size).encode())
+    with open(video_path, 'rb') as video_file:
+        for position in (0, size // 2, size - FRAME_CACHE_CHUNK_SIZE):
+            video_file.seek(max(position, 0))
+            sha1.update(video_file.read(FRAME_CACHE_CHUNK_SIZE))
+    return sha1.hexdigest()
+
+def frame_cache_key(video_path, **settings):
+    stat = os.stat(video_path)
+    key_content = {
+        "version": FRAME_CACHE_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "content": partial_content_hash(video_path),
+        "settings": settings,
+    }
+    return hashlib.sha1(json.dumps(key_content, sort_keys=True).encode()).hexdigest()
+
+def get_folder_size(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+# Copy a cached scene detection (time.txt and frames) into output_folder, returns the cached frame store (memory mapped,
+# read only) and the columns it was computed with (see frame_store_columns), or None if missing
+def load_frame_cache(cache_dir, cache_key, output_folder):
+    entry_folder = os.path.join(cache_dir, cache_key)
+    entry_file = os.path.join(entry_folder, 'entry.json')
+    if not os.path.isfile(entry_file):
+        return None
+
+    print(f"Using cached scene frames from {entry_folder}")
+    for file in os.listdir(entry_folder):
+        if file != 'entry.json' and file != 'frames.npy':
+            shutil.copy2(os.path.join(entry_folder, file), os.path.join(output_folder, file))
+
+    # the modification time of entry.json is the last use of the entry, needed by the LRU eviction
+    os.utime(entry_file)
+    with open(entry_file, 'r') as cache_file:
+        columns = json.load(cache_file).get('columns')
+    return np.load(os.path.join(entry_folder, 'frames.npy'), mmap_mode='r'), columns
+
+# Save the scene detection of output_folder (time.txt and frames) with its frame store, then evict the least recently used entries
+def store_frame_cache(cache_dir, cache_key, output_folder, frame_store, max_bytes, columns=None):
+    entry_folder = os.path.join(cache_dir, cache_key)
+    os.makedirs(entry_folder, exist_ok=True)
+    for file in os.listdir(output_folder):
+        if file.startswith("img") and file.endswith(".jpg") or file == "time.txt":
+            shutil.copy2(os.path.join(output_folder, file), os.path.join(entry_folder, file))
+    np.save(os.path.join(entry_folder, 'frames.npy'), frame_store)
+    # entry.json is written last, an entry without it is incomplete and is never loaded
+    with open(os.path.join(entry_folder, 'entry.json'), 'w') as cache_file:
+        json.dump({"created": time.time(), "frames": len(frame_store), "columns": columns}, cache_file)
+
+    evict_frame_cache(cache_dir, max_bytes)
+
+# Arrays of a score vector (see scene_scores.py) saved as a cache entry, evicted together with the scene frames entries
+def load_score_cache(cache_dir, cache_key):
+    entry_folder = os.path.join(cache_dir, cache_key)
+    entry_file = os.path.join(entry_folder, 'entry.json')
+    if not os.path.isfile(entry_file):
+        return None
+
+    print(f"Using cached frame scores from {entry_folder}")
+    with np.load(os.path.join(entry_folder, 'scores.npz')) as scores_file:
+        frame_scores = {name: scores_file[name] for name in scores_file.files}
+    os.utime(entry_file)
+    return frame_scores
+
+def store_score_cache(cache_dir, cache_key, frame_scores, max_bytes):
+    entry_folder = os.path.join(cache_dir, cache_key)
+    os.makedirs(entry_folder, exist_ok=True)
+    np.savez_compressed(os.path.join(entry_folder, 'scores.npz'), **frame_scores)
+    # entry.json is written last, an entry without it is incomplete and is never loaded
+    with open(os.path.join(entry_folder, 'entry.json'), 'w') as cache_file:
+        json.dump({"created": time.time(), "frames": len(frame_scores['pts'])}, cache_file)
+
+    evict_frame_cache(cache_dir, max_bytes)
+
+# Score vector of the last video scanned in a frame folder, used when there is no cache dir: only the file of the same
+# video (cache_key) is loaded
+def load_folder_scores(output_folder, cache_key):
+    scores_path = os.path.join(output_folder, FOLDER_SCORES_FILE)
+    if not os.path.isfile(scores_path):
+        return None
+    with np.load(scores_path) as scores_file:
+        if str(scores_file['cache_key']) != cache_key:
+            return None
+        print(f"Using frame scores saved in {scores_path}")
+        return {name: scores_file[name] for name in scores_file.files if name != 'cache_key'}
+
+def store_folder_scores(output_folder, cache_key, frame_scores):
+    np.savez_compressed(os.path.join(output_folder, FOLDER_SCORES_FILE), cache_key=np.array(cache_key), **frame_scores)
+
+def evict_frame_cache(cache_dir, max_bytes):
+    entries = []
+    for cache_key in os.listdir(cache_dir):
+        entry_folder = os.path.join(cache_dir, cache_key)
+        if not os.path.isdir(entry_folder):
+            continue
+        entry_file = os.path.join(entry_folder, 'entry.json')
+        # entries still being written by another run count as just used
+        last_use = os.path.getmtime(entry_file) if os.path.isfile(entry_file) else os.path.getmtime(entry_folder)
+        entries.append((last_use, get_folder_size(entry_folder), entry_folder))
+
+    total_bytes = sum(entry[1] for entry in entries)
+    for last_use, entry_bytes, entry_folder in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        print(f"Evicting scene frames cache entry {entry_folder}")
+        shutil.rmtree(entry_folder, ignore_errors=True)
+        total_bytes -= entry_bytes
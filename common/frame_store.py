@@ -0,0 +1,73 @@
+import imagehash
+import numpy as np
+import sys
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.twin_matching import pack_hash, popcount
+else:
+    # The application is running in a normal Python environment
+    from twin_matching import pack_hash, popcount
+
+# One row per scene frame with the fields of the old frame info dicts, the hash is packed in 64 bits (see pack_hash)
+# and hashed is False for the frames without a hash; rows are read like dicts (frame_info['pts_s']) and slices are views
+FRAME_STORE_DTYPE = np.dtype([
+    ('scene_frame_index', np.int64),
+    ('index', np.int64),
+    ('second_index', np.int64),
+    ('pts', np.int64),
+    ('pts_s', np.float64),
+    ('pts_ms', np.float64),
+    ('pts_time', np.float64),
+    ('audio_sample', np.float64),
+    ('hash', np.uint64),
+    ('hashed', np.bool_),
+])
+
+def pack_optional_hashes(hashes):
+    # ImageHash or None of every frame to the hash and hashed columns
+    hashed = np.array([hash is not None for hash in hashes], dtype=np.bool_)
+    packed = np.array([pack_hash(hash) if hash is not None else 0 for hash in hashes], dtype=np.uint64)
+    return packed, hashed
+
+# Frame store of the scenes found at pts, the other columns are computed from the video and audio properties
+def build_frame_store(scene_frame_indexes, pts, pts_time, hashes, hashed, video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame=0):
+    frame_store = np.zeros(len(pts), dtype=FRAME_STORE_DTYPE)
+    pts = np.asarray(pts, dtype=np.int64)
+    frame_store['scene_frame_index'] = scene_frame_indexes
+    frame_store['index'] = np.round(pts / video_pos_per_frame)
+    frame_store['second_index'] = np.round(frame_store['index'] % video_fps)
+    frame_store['pts'] = pts
+    frame_store['pts_s'] = pts / video_tbn
+    frame_store['pts_ms'] = pts / video_tbn * 1000
+    frame_store['pts_time'] = pts_time
+    frame_store['audio_sample'] = audio_samples_per_frame * (pts / video_pos_per_frame)
+    frame_store['hash'] = hashes
+    frame_store['hashed'] = hashed
+    return frame_store
+
+# Video and audio properties the computed columns depend on, saved with a cached store to know if it can be used as is
+def frame_store_columns(video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame=0):
+    return {"video_tbn": float(video_tbn), "video_fps": float(video_fps), "video_pos_per_frame": float(video_pos_per_frame), "audio_samples_per_frame": float(audio_samples_per_frame)}
+
+# Same store with the columns depending on the audio computed again (the cache is shared by scripts using different audio)
+def rebuild_frame_store(frame_store, video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame=0):
+    return build_frame_store(frame_store['scene_frame_index'], frame_store['pts'], frame_store['pts_time'], frame_store['hash'], frame_store['hashed'], video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame)
+
+def frame_hash(frame_info):
+    # ImageHash of a row, None if the frame has no hash
+    return imagehash.hex_to_hash(frame_hash_string(frame_info)) if frame_info['hashed'] else None
+
+def frame_hash_string(frame_info):
+    # same string of str(ImageHash)
+    return f"{int(frame_info['hash']):016x}" if frame_info['hashed'] else None
+
+def frame_hash_distance(frame_info, other_frame_info):
+    # None if one of the frames has no hash
+    if not (frame_info['hashed'] and other_frame_info['hashed']):
+        return None
+    return int(popcount(np.array([frame_info['hash'] ^ other_frame_info['hash']], dtype=np.uint64))[0])
+
+# Position of the frame with the nearest pts
+def find_frame_store_position(frame_store, pts):
+    return int(np.argmin(np.abs(frame_store['pts'] - pts)))
@@ -0,0 +1,298 @@
+import re
+import sys
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+    from common.scene_detection import *
+    from common.scene_scores import *
+    from common.frame_cache import *
+    from common.frame_store import *
+    from common.twin_matching import *
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+    from scene_detection import *
+    from scene_scores import *
+    from frame_cache import *
+    from frame_store import *
+    from twin_matching import *
+
+# Frame information of the scenes listed in the time.txt of output_folder
+# without known_hashes the img%05d.jpg are hashed, after removing their borders with trim_mode 'frame' or 'magick'
+def read_frame_info(output_folder, known_hashes, video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame=0, trim_mode=None, imagemagick_script='magick'):
+    # Parse time.txt to capture frame information
+    scene_frame_indexes = []
+    pts_values = []
+    pts_times = []
+    hashes = []
+    with open(f"{output_folder}/time.txt", "r") as time_file:
+        lines = time_file.readlines()
+        for index, line in enumerate(lines):
+            match = re.match(r'frame:(\d+)\s+pts:(\d+)\s+pts_time:(\d+.?\d*)', line)
+            if match:
+                scene_frame_index = int(match.group(1))
+                scene_frame_indexes.append(scene_frame_index)
+                pts_values.append(int(match.group(2)))
+                pts_times.append(float(match.group(3)))
+                if known_hashes is not None:
+                    # frames hashed in memory have borders already removed
+                    hashes.append(known_hashes.get(scene_frame_index))
+
+    if known_hashes is None:
+        hashes = hash_scene_images(output_folder, scene_frame_indexes, trim_mode, imagemagick_script)
+
+    packed_hashes, hashed = pack_optional_hashes(hashes)
+    return build_frame_store(scene_frame_indexes, pts_values, pts_times, packed_hashes, hashed, video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame)
+
+# Function to run FFmpeg command and capture frame information
+# with edge_seconds only the frame info of the edges is returned, with what finish_capture_frame_info needs to get the whole video
+# audio_samples_per_frame is 0 when the audio samples are not needed (subtitles)
+def capture_frame_info(video_path, output_folder, frame_diff, video_tbn, video_fps, video_pos_per_frame, ffmpeg_script, progress_label, video_duration, segments, segment_overlap, segment_workers, cache_dir, cache_max_bytes, stream_hashes, preview_width, edge_seconds=0, detection_fps=0, skip_frame='none', scene_detector='ffmpeg', cut_borders=False, border_detection='video', imagemagick_script='magick', audio_samples_per_frame=0):
+    print(f"[{progress_label}] Getting video new scene frame information via ffmpeg...")
+    cache_key = None
+    known_hashes = None
+    columns = frame_store_columns(video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame)
+    if cache_dir:
+        cache_key = frame_cache_key(video_path, frame_diff=frame_diff, cut_borders=cut_borders, stream_hashes=stream_hashes, preview_width=preview_width, detection_fps=detection_fps, skip_frame=skip_frame, scene_detector=scene_detector, border_detection=border_detection)
+        cached = load_frame_cache(cache_dir, cache_key, output_folder)
+        if cached is not None:
+            cached_frames, cached_columns = cached
+            if cached_columns == columns:
+                # the memory mapped store is used as is, nothing is copied
+                return cached_frames, None
+            # only the columns depending on the video and the audio are computed again
+            return rebuild_frame_store(cached_frames, video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame), None
+
+    crop = None
+    trim_mode = None
+    if cut_borders and border_detection == 'video':
+        # borders found once and cropped by ffmpeg, scene frames need no trimming
+        crop = detect_video_crop(video_path, ffmpeg_script, video_duration)
+        print(f"[{progress_label}] Black borders detected, scene frames cropped to {crop or 'the whole picture'}")
+    elif cut_borders:
+        trim_mode = border_detection
+    # frames hashed in memory are trimmed in-process, magick works on files only
+    trim_frames = trim_mode is not None
+
+    scene_pending = None
+    if scene_detector == 'scores':
+        # the score vector of the video is cached on its own, another frame_diff is found without decoding it again
+        scenes = extract_scene_frames_from_scores(
+            video_path=video_path,
+            output_folder=output_folder,
+            frame_diff=frame_diff,
+            video_tbn=video_tbn,
+            video_fps=video_fps,
+            video_duration=video_duration,
+            segments=segments,
+            overlap=segment_overlap,
+            max_workers=segment_workers,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=progress_label,
+            preview_width=preview_width,
+            cut_borders=trim_frames,
+            cache_dir=cache_dir,
+            cache_max_bytes=cache_max_bytes,
+            crop=crop
+        )
+    elif edge_seconds and video_duration > 2 * edge_seconds:
+        # the edges are enough to choose the safe pairs, the middle is decoded in the background
+        scenes, scene_pending = start_scene_frames_edges_first(
+            video_path=video_path,
+            output_folder=output_folder,
+            frame_diff=frame_diff,
+            video_tbn=video_tbn,
+            video_fps=video_fps,
+            video_duration=video_duration,
+            edge_seconds=edge_seconds,
+            middle_segments=segments,
+            overlap=segment_overlap,
+            max_workers=segment_workers,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=progress_label,
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            cut_borders=trim_frames,
+            detection_fps=detection_fps,
+            skip_frame=skip_frame,
+            crop=crop
+        )
+    elif segments > 1:
+        scenes = extract_scene_frames_segmented(
+            video_path=video_path,
+            output_folder=output_folder,
+            frame_diff=frame_diff,
+            video_tbn=video_tbn,
+            video_fps=video_fps,
+            video_duration=video_duration,
+            segments=segments,
+            overlap=segment_overlap,
+            max_workers=segment_workers,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=progress_label,
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            cut_borders=trim_frames,
+            detection_fps=detection_fps,
+            skip_frame=skip_frame,
+            crop=crop
+        )
+    else:
+        scenes = extract_scene_frames(
+            video_path=video_path,
+            output_folder=output_folder,
+            frame_diff=frame_diff,
+            video_duration=video_duration,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=progress_label,
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            cut_borders=trim_frames,
+            detection_fps=detection_fps,
+            skip_frame=skip_frame,
+            video_tbn=video_tbn,
+            video_fps=video_fps,
+            crop=crop
+        )
+    if stream_hashes or scene_detector == 'scores':
+        # frames have been hashed in memory while ffmpeg was running
+        known_hashes = {scene['scene_frame_index']: scene['hash'] for scene in scenes}
+
+    frame_info = read_frame_info(output_folder, known_hashes, video_tbn, video_fps, video_pos_per_frame, audio_samples_per_frame, trim_mode, imagemagick_script)
+    if scene_pending is not None:
+        # cached once the whole video is known
+        return frame_info, {"scenes": scene_pending, "stream_hashes": stream_hashes, "cache_dir": cache_dir, "cache_key": cache_key, "cache_max_bytes": cache_max_bytes, "columns": columns, "read_args": dict(output_folder=output_folder, trim_mode=trim_mode, imagemagick_script=imagemagick_script, video_tbn=video_tbn, video_fps=video_fps, video_pos_per_frame=video_pos_per_frame, audio_samples_per_frame=audio_samples_per_frame)}
+
+    if cache_dir:
+        store_frame_cache(cache_dir, cache_key, output_folder, frame_info, cache_max_bytes, columns)
+
+    return frame_info, None
+
+# Frame info of the whole video once the background scan of the middle started by capture_frame_info with edge_seconds is over
+def finish_capture_frame_info(frame_info, pending):
+    if pending is None:
+        return frame_info
+    scenes = finish_scene_frames_edges_first(pending['scenes'])
+    known_hashes = {scene['scene_frame_index']: scene['hash'] for scene in scenes} if pending['stream_hashes'] else None
+    frame_info = read_frame_info(known_hashes=known_hashes, **pending['read_args'])
+
+    if pending['cache_dir']:
+        store_frame_cache(pending['cache_dir'], pending['cache_key'], pending['read_args']['output_folder'], frame_info, pending['cache_max_bytes'], pending['columns'])
+
+    return frame_info
+
+# Index of the frame with the nearest pts, scene_frame_index changes when the middle scenes are added to the edge ones
+def find_frame_info_index(frame_infos, pts):
+    return find_frame_store_position(frame_infos, pts)
+
+def is_sorted(arr):
+    for i in range(len(arr) - 1):
+        if arr[i] > arr[i + 1]:
+            return False
+    return True
+
+# Pairs of scene frames with the nearest hashes, twins appearing more times or out of order are removed
+# raises ValueError when the order of the pairs cannot be fixed
+def find_twin_frames(main_frame_infos, brothers_frame_infos, reverse_main_and_twin = False, search_window = 0, time_window = 0, alignment = 'greedy', alignment_max_distance = 10, alignment_gap_penalty = 1, alignment_band = 0):
+    # positions below are positions in the hashed frames, pairs keep the scene frame indexes
+    main_frame_infos = hashed_frame_infos(main_frame_infos)
+    brothers_frame_infos = hashed_frame_infos(brothers_frame_infos)
+    main_hashes = pack_hashes(main_frame_infos)
+    brother_hashes = pack_hashes(brothers_frame_infos)
+    if alignment == 'dp':
+        # optimal monotonic alignment: twins are already unique and in order, nothing to remove
+        pairs = []
+        for main_position, twin_position, twin_distance in align_hashes_monotonic(main_hashes, brother_hashes, alignment_max_distance, alignment_gap_penalty, alignment_band):
+            pair = {'main': int(main_frame_infos[main_position]['scene_frame_index']), 'twin': int(brothers_frame_infos[twin_position]['scene_frame_index']), 'distance': twin_distance }
+            if reverse_main_and_twin:
+                pair['main'], pair['twin'] = pair['twin'], pair['main']
+            pairs.append(pair)
+        return pairs
+
+    if time_window:
+        # first and last frames of both sides are the safe start and end pairs, they predict where to search the twin
+        twin_positions, twin_distances = find_nearest_hashes_in_time(
+            main_frame_infos['pts_s'], main_hashes,
+            brothers_frame_infos['pts_s'], brother_hashes,
+            time_window
+        )
+    else:
+        # hamming distances of all the hashes are computed at once
+        twin_positions, twin_distances = find_nearest_hashes(main_hashes, brother_hashes, search_window)
+    pairs = []
+    for main_frame_info, twin_position, twin_distance in zip(main_frame_infos, twin_positions, twin_distances):
+        if twin_position < 0:
+            # no candidate in the time window
+            continue
+        pairs.append({'main': int(main_frame_info['scene_frame_index']), 'twin': int(brothers_frame_infos[twin_position]['scene_frame_index']), 'distance': int(twin_distance) })
+
+    # remove bad twins
+    # - twin appearing multiple times
+    # - twin not in order
+    double_twin_indexes = {}
+    bad_indexes = []
+
+    # bad side AFTER the reversing
+    # the "bad" side is always the one with the most frames
+    # if it is the source it will be main (because AFTER reversal it is main)
+    # if it is the target it will be twin (because AFTER reversal it is twin)
+    possibly_bad_side = 'main' if reverse_main_and_twin else 'twin'
+    
+    for index, pair in enumerate(pairs):
+        # if requested to use twin as main
+        if reverse_main_and_twin:
+            print('reversing', pair['twin'], 'and replacing it with', pair['main'])
+            print(pair)
+            temp_twin = pair['twin']
+            pair['twin'] = pair['main']
+            pair['main'] = temp_twin
+        
+        # count frame appearance (will use it to find double appearance)
+        if pair[possibly_bad_side] not in double_twin_indexes:
+            double_twin_indexes[pair[possibly_bad_side]] = []
+        double_twin_indexes[pair[possibly_bad_side]].append(index)
+   
+    # remove twin appearing multiple times
+    for value in double_twin_indexes.values():
+        if len(value) > 1:
+            print(f"Same frame indexes: {value}")
+            bad_indexes += value
+        
+    for bad_index in sorted(bad_indexes, reverse=True):
+        pairs.pop(bad_index)
+
+    # NOTE this only works with 1 frame error groups, but I've never found bigger groups in my tests
+    bad_indexes = []
+    for index, pair in enumerate(pairs):
+        # a frame cannot have a lower index than the previous one
+        if index > 0 and pair[possibly_bad_side] < pairs[index - 1][possibly_bad_side]:
+            bad_indexes.append(index)
+        # a frame cannot have a higher index than the next one
+        if index < len(pairs) - 1 and pair[possibly_bad_side] > pairs[index + 1][possibly_bad_side]:
+            bad_indexes.append(index)
+    
+    for bad_index in sorted(bad_indexes, reverse=True):
+        pairs.pop(bad_index)
+
+    pairs_twin_indexes = [pair[possibly_bad_side] for pair in pairs if pair[possibly_bad_side] in pairs]
+    if not is_sorted(pairs_twin_indexes):
+        raise ValueError('Found a case unhandled by the software: too much unordered groups of frames')
+
+    return pairs
+
+def describe_frame_infos(frame_dict):
+    description = {
+        'scene_frame_index': f"Scene Frame Index: {frame_dict['scene_frame_index']}",
+        'index': f"Index: {frame_dict['index']}",
+        'second_index': f"Index inside second: {frame_dict['second_index']}",
+        'pts': f"PTS (Timestamp): {frame_dict['pts']}",
+        'pts_s': f"PTS (Seconds): {frame_dict['pts_s']:.4f}",
+        'pts_ms': f"PTS (Milliseconds): {frame_dict['pts_ms']:.1f}",
+        'pts_time': f"PTS (Time): {frame_dict['pts_time']:.4f}",
+        'hash': f"Hash String: {frame_hash_string(frame_dict)}"
+    }
+
+    for key, value in description.items():
+        print(value)
+    print("----------------------------------")
@@ -0,0 +1,384 @@
+import imagehash
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+
+SCENE_LINE_REGEX = re.compile(r'frame:(\d+)\s+pts:(\d+)\s+pts_time:(\d+.?\d*)')
+# side of the grayscale frames piped by ffmpeg when hashing in memory (average_hash reduces them to 8x8)
+HASH_FRAME_SIZE = 64
+# width of the frames analyzed by the first pass of the fast scene detection
+FAST_DETECTION_WIDTH = 480
+# the first pass of the fast scene detection compares the plain difference (mafd) of the analyzed frames with this fraction of
+# the threshold: the scene score is reduced by the difference of the previous pair, always high when frames are far apart
+# the second pass discards the wrong candidates
+FAST_DETECTION_THRESHOLD_RATIO = 0.5
+# scdet differences are percents of the pixel range, the select scene score (and frame_diff) divides them by 100 instead of 256
+SCDET_TO_SCENE_DIFF = 2.56
+# seconds decoded at full frame rate before and after every candidate cut found by the fast scene detection
+FAST_DETECTION_MARGIN = 0.2
+# windows around candidate cuts decoded at the same time by the fast scene detection
+FAST_DETECTION_WORKERS = 4
+# positions spread over the video where cropdetect looks for the borders, and frames decoded at every position
+# (cropdetect skips the first 2 frames it gets)
+CROP_DETECTION_SAMPLES = 12
+CROP_DETECTION_FRAMES = 8
+CROP_DETECTION_WORKERS = 4
+
+def build_segment(index, own_start, own_end, duration, overlap):
+    # Every segment owns [own_start, own_end) and is decoded from own_start - overlap to own_end + overlap,
+    # the overlap is needed because the first decoded frame of a segment can never be a new scene
+    decode_start = max(own_start - overlap, 0)
+    decode_end = min(own_end + overlap, duration)
+    return {
+        "index": index,
+        "own_start": own_start,
+        "own_end": own_end,
+        "decode_start": decode_start,
+        "decode_duration": decode_end - decode_start,
+    }
+
+def split_in_segments(duration, segments, overlap):
+    segment_duration = duration / segments
+    result = []
+    for index in range(segments):
+        own_start = index * segment_duration
+        own_end = duration if index == segments - 1 else (index + 1) * segment_duration
+        result.append(build_segment(index, own_start, own_end, duration, overlap))
+    return result
+
+# First and last edge_seconds as a segment each, with the middle of the video split in middle_segments between them
+def split_in_edge_segments(duration, edge_seconds, middle_segments, overlap):
+    middle_duration = (duration - 2 * edge_seconds) / middle_segments
+    bounds = [0, edge_seconds] + [edge_seconds + index * middle_duration for index in range(1, middle_segments)] + [duration - edge_seconds, duration]
+    return [build_segment(index, bounds[index], bounds[index + 1], duration, overlap) for index in range(len(bounds) - 1)]
+
+# In-process equivalent of "magick mogrify -fuzz 4% -trim": remove the borders having the color of the top-left pixel
+def trim_borders(img, fuzz_percentage=4):
+    background = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    threshold = 255 * fuzz_percentage / 100
+    difference = ImageChops.difference(img, background).point(lambda value: 255 if value > threshold else 0)
+    bbox = difference.getbbox()
+    return img.crop(bbox) if bbox else img
+
+# Bounds [x1, y1, x2, y2] of the non black part of a few frames decoded at seek seconds, None if they are all black
+def detect_crop_bounds(video_path, ffmpeg_script, seek):
+    ffmpeg_cmd = (
+        f"{ffmpeg_script} -loglevel quiet -ss {seek} -i \"{video_path}\" -frames:v {CROP_DETECTION_FRAMES} "
+        f"-vf \"cropdetect=round=2,metadata=print:file=-\" -an -f null -"
+    )
+    result = run_process(ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+    # cropdetect keeps the widest bounds seen so far, the last printed frame has the bounds of all of them
+    values = {}
+    for line in result.stdout.splitlines():
+        if line.startswith("lavfi.cropdetect."):
+            name, value = line[len("lavfi.cropdetect."):].split("=", 1)
+            values[name] = int(float(value))
+    if not all(name in values for name in ('x1', 'y1', 'x2', 'y2')) or values['x2'] < values['x1'] or values['y2'] < values['y1']:
+        return None
+    return [values['x1'], values['y1'], values['x2'], values['y2']]
+
+# Crop filter parameters ("w:h:x:y") removing the black borders of the whole video, found once on frames sampled over all
+# its duration: the crop keeps every pixel that is not black in at least one sample, dark scenes never cut the picture
+def detect_video_crop(video_path, ffmpeg_script, video_duration):
+    samples_bounds = run_parallel(detect_crop_bounds, [
+        dict(video_path=video_path, ffmpeg_script=ffmpeg_script, seek=(index + 0.5) * video_duration / CROP_DETECTION_SAMPLES)
+        for index in range(CROP_DETECTION_SAMPLES)
+    ], max_workers=CROP_DETECTION_WORKERS)
+    samples_bounds = [bounds for bounds in samples_bounds if bounds is not None]
+    if not samples_bounds:
+        return None
+    x1 = min(bounds[0] for bounds in samples_bounds)
+    y1 = min(bounds[1] for bounds in samples_bounds)
+    x2 = max(bounds[2] for bounds in samples_bounds)
+    y2 = max(bounds[3] for bounds in samples_bounds)
+    return f"{x2 - x1 + 1}:{y2 - y1 + 1}:{x1}:{y1}"
+
+# Average hash of a scene image, with trim_mode 'frame' (in-process) or 'magick' (imagemagick_script) its borders are
+# removed first and the trimmed image replaces it, None if the image does not exist
+def hash_scene_image(image_path, trim_mode=None, imagemagick_script='magick'):
+    if trim_mode == 'magick':
+        run_process(f"{imagemagick_script} mogrify -fuzz 4% -define trim:percent-background=0% -trim +repage -format jpg \"{image_path}\"", stdin=subprocess.DEVNULL)
+    try:
+        img = Image.open(image_path)
+    except FileNotFoundError:
+        return None
+    if trim_mode == 'frame':
+        img = trim_borders(img)
+        img.save(image_path)
+    return imagehash.average_hash(img)
+
+# Hashes of the img%05d.jpg of the scenes in output_folder, images are trimmed and hashed by a pool of threads
+def hash_scene_images(output_folder, scene_frame_indexes, trim_mode=None, imagemagick_script='magick', max_workers=None):
+    return run_parallel(hash_scene_image, [
+        # NOTE: file names start from 1, not 0 like the index
+        dict(image_path='{}/img{:05d}.jpg'.format(output_folder, scene_frame_index + 1), trim_mode=trim_mode, imagemagick_script=imagemagick_script)
+        for scene_frame_index in scene_frame_indexes
+    ], max_workers=max_workers or os.cpu_count() or 1)
+
+def hash_gray_frame(buffer, cut_borders):
+    img = Image.frombytes('L', (HASH_FRAME_SIZE, HASH_FRAME_SIZE), buffer)
+    if cut_borders:
+        img = trim_borders(img)
+    return imagehash.average_hash(img)
+
+def hash_raw_gray_frames(stream, cut_borders):
+    hashes = []
+    frame_bytes = HASH_FRAME_SIZE * HASH_FRAME_SIZE
+    while True:
+        buffer = stream.read(frame_bytes)
+        if len(buffer) < frame_bytes:
+            break
+        hashes.append(hash_gray_frame(buffer, cut_borders))
+    return hashes
+
+# Run ffmpeg scene detection writing time.txt (and img%05d.jpg frames) in output_folder, optionally only on a segment of the video
+# with stream_hashes the frames are piped as small grayscale rawvideo and hashed in memory, img%05d.jpg become previews
+# preview_width pixels wide (none if 0)
+# with detection_fps or skip_frame the fast scene detection is used (video_tbn and video_fps are needed), no progress is reported if progress_label is None
+# crop ("w:h:x:y", see detect_video_crop) is applied to the scene frames only, the scene score is computed on the whole picture
+def extract_scene_frames(video_path, output_folder, frame_diff, video_duration, ffmpeg_script, progress_label, segment=None, stream_hashes=False, preview_width=0, cut_borders=False, detection_fps=0, skip_frame='none', video_tbn=0, video_fps=0, crop=None):
+    os.makedirs(output_folder, exist_ok=True)
+    if segment is None:
+        ffmpeg_input = f"-i \"{video_path}\""
+        progress_duration = video_duration
+    else:
+        # input options: -t after -i would limit only the first output, the previews would be decoded until the end
+        ffmpeg_input = f"-ss {segment['decode_start']} -t {segment['decode_duration']} -i \"{video_path}\""
+        progress_duration = segment['decode_duration']
+    if detection_fps or skip_frame != 'none':
+        return extract_scene_frames_fast(video_path, output_folder, frame_diff, ffmpeg_script, progress_label, ffmpeg_input, progress_duration, segment, stream_hashes, preview_width, cut_borders, detection_fps, skip_frame, video_tbn, video_fps, crop)
+    crop_filter = f",crop={crop}" if crop else ""
+    select_filter = f"select='gt(scene,{frame_diff/100})',metadata=print:file={output_folder}/time.txt{crop_filter}"
+
+    hashes = None
+    if not stream_hashes:
+        ffmpeg_cmd = (
+            f"{ffmpeg_script} -loglevel quiet {FFMPEG_PROGRESS_ARGS} {ffmpeg_input} "
+            f"-filter_complex \"{select_filter}\" "
+            f"-vsync vfr \"{output_folder}/img%05d.jpg\""
+        )
+        run_ffmpeg_with_progress(ffmpeg_cmd, progress_label, progress_duration)
+    else:
+        hash_filter = f"scale={HASH_FRAME_SIZE}:{HASH_FRAME_SIZE},format=gray"
+        if preview_width:
+            filter_graph = f"{select_filter},split=2[hash][preview];[hash]{hash_filter}[hashout];[preview]scale={preview_width}:-2[previewout]"
+            preview_output = f"-map \"[previewout]\" -vsync vfr \"{output_folder}/img%05d.jpg\""
+        else:
+            filter_graph = f"{select_filter},{hash_filter}[hashout]"
+            preview_output = ""
+        ffmpeg_cmd = (
+            f"{ffmpeg_script} -loglevel quiet {FFMPEG_STDERR_PROGRESS_ARGS} {ffmpeg_input} "
+            f"-filter_complex \"{filter_graph}\" "
+            f"-map \"[hashout]\" -vsync vfr -f rawvideo pipe:1 {preview_output}"
+        )
+        hashes = []
+        run_ffmpeg_with_progress(ffmpeg_cmd, progress_label, progress_duration, stdout_reader=lambda stream: hashes.extend(hash_raw_gray_frames(stream, cut_borders)))
+
+    scenes = []
+    if not os.path.isfile(f"{output_folder}/time.txt"):
+        return scenes
+    with open(f"{output_folder}/time.txt", "r") as time_file:
+        for line in time_file:
+            match = SCENE_LINE_REGEX.match(line)
+            if match:
+                scene_frame_index = int(match.group(1))
+                scenes.append({
+                    "scene_frame_index": scene_frame_index,
+                    "pts": int(match.group(2)),
+                    "pts_time": float(match.group(3)),
+                    # every selected frame is both printed and piped, so they have the same order
+                    "hash": hashes[scene_frame_index] if hashes is not None and scene_frame_index < len(hashes) else None,
+                })
+    return scenes
+
+# Scene detection in two passes: candidate cuts are found on downscaled frames (at detection_fps if set, decoding only the
+# reference frames or the keyframes with skip_frame noref/nokey), then only the windows between every candidate and the
+# previous analyzed frame are decoded at full frame rate and size to find the exact cut frames
+# Decoding is most of the work: the first pass is fast when frames are skipped, the second one when there are few cuts
+def extract_scene_frames_fast(video_path, output_folder, frame_diff, ffmpeg_script, progress_label, ffmpeg_input, progress_duration, segment, stream_hashes, preview_width, cut_borders, detection_fps, skip_frame, video_tbn, video_fps, crop=None):
+    skip_frame_option = f"-skip_frame {skip_frame} " if skip_frame != 'none' else ""
+    fps_filter = f"fps={detection_fps}," if detection_fps else ""
+    scores_path = f"{output_folder}/scores.txt"
+    # the difference of every analyzed frame from the previous one is printed
+    ffmpeg_cmd = (
+        f"{ffmpeg_script} -loglevel quiet {FFMPEG_PROGRESS_ARGS} {skip_frame_option}{ffmpeg_input} "
+        f"-filter_complex \"{fps_filter}scale={FAST_DETECTION_WIDTH}:-2,scdet=threshold=100,metadata=print:key=lavfi.scd.mafd:file={scores_path}\" "
+        f"-f null -"
+    )
+    run_ffmpeg_with_progress(ffmpeg_cmd, progress_label, progress_duration)
+
+    frame_times = []
+    frame_differences = []
+    if os.path.isfile(scores_path):
+        with open(scores_path, "r") as scores_file:
+            for line in scores_file:
+                match = SCENE_LINE_REGEX.match(line)
+                if match:
+                    frame_times.append(float(match.group(3)))
+                elif line.startswith("lavfi.scd.mafd=") and len(frame_differences) < len(frame_times):
+                    frame_differences.append(float(line.split("=")[1]))
+        os.remove(scores_path)
+
+    candidate_count = 0
+    windows = []
+    for index in range(1, len(frame_differences)):
+        if frame_differences[index] * SCDET_TO_SCENE_DIFF <= frame_diff * FAST_DETECTION_THRESHOLD_RATIO:
+            continue
+        candidate_count += 1
+        # the cut is after the first of the identical frames before the candidate (frames are repeated by the fps filter
+        # when they are skipped), near windows are decoded together
+        previous_index = index - 1
+        while previous_index > 0 and frame_differences[previous_index] == 0:
+            previous_index -= 1
+        own_start = max(frame_times[previous_index] - FAST_DETECTION_MARGIN, 0)
+        own_end = min(frame_times[index] + FAST_DETECTION_MARGIN, progress_duration)
+        if windows and own_start <= windows[-1]['own_end']:
+            windows[-1] = build_segment(windows[-1]['index'], windows[-1]['own_start'], own_end, progress_duration, FAST_DETECTION_MARGIN)
+        else:
+            windows.append(build_segment(len(windows), own_start, own_end, progress_duration, FAST_DETECTION_MARGIN))
+    # a cut after the last analyzed frame (the last keyframe with nokey) has no candidate, the end is always decoded
+    last_index = len(frame_differences) - 1
+    while last_index > 0 and frame_differences[last_index] == 0:
+        last_index -= 1
+    tail_start = max(frame_times[last_index] - FAST_DETECTION_MARGIN, 0) if last_index >= 0 else 0
+    if windows and tail_start <= windows[-1]['own_end']:
+        windows[-1] = build_segment(windows[-1]['index'], windows[-1]['own_start'], progress_duration, progress_duration, FAST_DETECTION_MARGIN)
+    else:
+        windows.append(build_segment(len(windows), tail_start, progress_duration, progress_duration, FAST_DETECTION_MARGIN))
+    if progress_label is not None:
+        windows_duration = sum(window['decode_duration'] for window in windows)
+        print(f"[{progress_label}] {candidate_count} candidate cuts, decoding {len(windows)} windows around them ({windows_duration:.1f}s)")
+
+    # windows are relative to the decoded part of the video
+    decode_start = segment['decode_start'] if segment is not None else 0
+    windows_scenes = run_parallel(extract_scene_frames, [
+        dict(
+            video_path=video_path,
+            output_folder=segment_folder(output_folder, window),
+            frame_diff=frame_diff,
+            video_duration=progress_duration,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=None,
+            segment={**window, "decode_start": decode_start + window['decode_start']},
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            cut_borders=cut_borders,
+            crop=crop
+        ) for window in windows
+    ], max_workers=FAST_DETECTION_WORKERS)
+    return stitch_segments_scene_frames(output_folder, windows, windows_scenes, video_tbn, video_fps)
+
+def segment_folder(output_folder, segment):
+    return f"{output_folder}/segment{segment['index']:03d}"
+
+def extract_segments_scene_frames(video_path, output_folder, frame_diff, video_duration, video_segments, max_workers, ffmpeg_script, progress_label, segments_count, stream_hashes=False, preview_width=0, cut_borders=False, detection_fps=0, skip_frame='none', video_tbn=0, video_fps=0, crop=None):
+    return run_parallel(extract_scene_frames, [
+        dict(
+            video_path=video_path,
+            output_folder=segment_folder(output_folder, segment),
+            frame_diff=frame_diff,
+            video_duration=video_duration,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=f"{progress_label} {segment['index'] + 1}/{segments_count}",
+            segment=segment,
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            cut_borders=cut_borders,
+            detection_fps=detection_fps,
+            skip_frame=skip_frame,
+            video_tbn=video_tbn,
+            video_fps=video_fps,
+            crop=crop
+        ) for segment in video_segments
+    ], max_workers=max_workers)
+
+# Write time.txt and img%05d.jpg in output_folder as if the scenes of the segments came from a single ffmpeg run
+# with keep_segments the frames are copied and the segment folders are kept, so that they can be stitched again later
+def stitch_segments_scene_frames(output_folder, video_segments, segments_scenes, video_tbn, video_fps, keep_segments=False):
+    # Rebase the PTS of every segment on the full video and keep only the scenes inside the segment owned range
+    stitched_scenes = []
+    for segment, scenes in zip(video_segments, segments_scenes):
+        pts_offset = round(segment['decode_start'] * video_tbn)
+        for scene in scenes:
+            pts = scene['pts'] + pts_offset
+            pts_time = pts / video_tbn
+            if segment['own_start'] <= pts_time < segment['own_end']:
+                stitched_scenes.append({**scene, "pts": pts, "pts_time": pts_time, "segment": segment})
+    stitched_scenes.sort(key=lambda scene: scene['pts'])
+
+    # Rounding of the seek position can still make the same cut appear in two segments: less than half a frame apart
+    half_frame_pts = video_tbn / video_fps / 2
+    unique_scenes = []
+    for scene in stitched_scenes:
+        if unique_scenes and scene['pts'] - unique_scenes[-1]['pts'] < half_frame_pts:
+            continue
+        unique_scenes.append(scene)
+
+    # Move frames and write time.txt as if they came from a single ffmpeg run
+    result = []
+    with open(f"{output_folder}/time.txt", "w") as time_file:
+        for scene_frame_index, scene in enumerate(unique_scenes):
+            # NOTE: file names start from 1, not 0 like the index
+            segment_image = '{}/img{:05d}.jpg'.format(segment_folder(output_folder, scene['segment']), scene['scene_frame_index'] + 1)
+            if os.path.isfile(segment_image):
+                if keep_segments:
+                    shutil.copyfile(segment_image, '{}/img{:05d}.jpg'.format(output_folder, scene_frame_index + 1))
+                else:
+                    os.replace(segment_image, '{}/img{:05d}.jpg'.format(output_folder, scene_frame_index + 1))
+            time_file.write(f"frame:{scene_frame_index} pts:{scene['pts']} pts_time:{scene['pts_time']}\n")
+            result.append({
+                "scene_frame_index": scene_frame_index,
+                "pts": scene['pts'],
+                "pts_time": scene['pts_time'],
+                "hash": scene['hash'],
+            })
+
+    if not keep_segments:
+        for segment in video_segments:
+            shutil.rmtree(segment_folder(output_folder, segment), ignore_errors=True)
+
+    return result
+
+# Same output of a single extract_scene_frames run on the whole video (time.txt and img%05d.jpg in output_folder),
+# but the video is split in time segments that are decoded at the same time
+def extract_scene_frames_segmented(video_path, output_folder, frame_diff, video_tbn, video_fps, video_duration, segments, overlap, max_workers, ffmpeg_script, progress_label, stream_hashes=False, preview_width=0, cut_borders=False, detection_fps=0, skip_frame='none', crop=None):
+    video_segments = split_in_segments(video_duration, segments, overlap)
+    segments_scenes = extract_segments_scene_frames(video_path, output_folder, frame_diff, video_duration, video_segments, max_workers, ffmpeg_script, progress_label, segments, stream_hashes, preview_width, cut_borders, detection_fps, skip_frame, video_tbn, video_fps, crop)
+    return stitch_segments_scene_frames(output_folder, video_segments, segments_scenes, video_tbn, video_fps)
+
+# Output of extract_scene_frames_segmented for the first and last edge_seconds of the video only, returned as soon as they are decoded
+# the middle (split in middle_segments) is decoded by a background thread, finish_scene_frames_edges_first waits for it and writes
+# the output of the whole video, scene_frame_index of the scenes after the head changes
+def start_scene_frames_edges_first(video_path, output_folder, frame_diff, video_tbn, video_fps, video_duration, edge_seconds, middle_segments, overlap, max_workers, ffmpeg_script, progress_label, stream_hashes=False, preview_width=0, cut_borders=False, detection_fps=0, skip_frame='none', crop=None):
+    video_segments = split_in_edge_segments(video_duration, edge_seconds, middle_segments, overlap)
+    edge_segments = [video_segments[0], video_segments[-1]]
+    edge_scenes = extract_segments_scene_frames(video_path, output_folder, frame_diff, video_duration, edge_segments, 2, ffmpeg_script, progress_label, len(video_segments), stream_hashes, preview_width, cut_borders, detection_fps, skip_frame, video_tbn, video_fps, crop)
+    scenes = stitch_segments_scene_frames(output_folder, edge_segments, edge_scenes, video_tbn, video_fps, keep_segments=True)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    middle_future = executor.submit(extract_segments_scene_frames, video_path, output_folder, frame_diff, video_duration, video_segments[1:-1], max_workers, ffmpeg_script, progress_label, len(video_segments), stream_hashes, preview_width, cut_borders, detection_fps, skip_frame, video_tbn, video_fps, crop)
+    executor.shutdown(wait=False)
+    return scenes, {
+        "output_folder": output_folder,
+        "segments": video_segments,
+        "edge_scenes": edge_scenes,
+        "middle_future": middle_future,
+        "video_tbn": video_tbn,
+        "video_fps": video_fps
+    }
+
+def finish_scene_frames_edges_first(pending):
+    middle_scenes = pending['middle_future'].result()
+    segments_scenes = [pending['edge_scenes'][0]] + middle_scenes + [pending['edge_scenes'][1]]
+    return stitch_segments_scene_frames(pending['output_folder'], pending['segments'], segments_scenes, pending['video_tbn'], pending['video_fps'])
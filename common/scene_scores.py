@@ -0,0 +1,230 @@
+import imagehash
+import numpy as np
+import os
+import shutil
+import sys
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+    from common.scene_detection import *
+    from common.frame_cache import *
+    from common.twin_matching import pack_hash
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+    from scene_detection import *
+    from frame_cache import *
+    from twin_matching import pack_hash
+
+# frames read from the ffmpeg pipe and compared at the same time
+SCORE_BLOCK_FRAMES = 256
+# frames scoring less than this percentage are not hashed, a lower frame_diff needs a new scan
+SCORE_HASH_FLOOR_PERCENTAGE = 5
+# the preview select expression is written in a file next to the previews, too long for a command line
+PREVIEW_FILTER_FILE = "preview_filter.txt"
+
+def read_frames(stream, frames):
+    # Fill frames with whole frames from the pipe, returns how many have been read (less only at the end)
+    view = memoryview(frames).cast('B')
+    read_bytes = 0
+    while read_bytes < len(view):
+        count = stream.readinto(view[read_bytes:])
+        if not count:
+            break
+        read_bytes += count
+    return read_bytes // frames.shape[1]
+
+# Score of every frame like the ffmpeg scene score: mean absolute difference from the previous frame (mafd), reduced
+# by its change from the previous pair so that steady motion is not a new scene, from 0 to 1
+# frames scoring at least hash_floor are hashed like in hash_raw_gray_frames
+def score_raw_gray_frames(stream, cut_borders, hash_floor):
+    frame_bytes = HASH_FRAME_SIZE * HASH_FRAME_SIZE
+    # ring buffer of a block of frames, row 0 keeps the last frame of the previous block
+    frames = np.zeros((SCORE_BLOCK_FRAMES + 1, frame_bytes), dtype=np.uint8)
+    block_scores = []
+    block_hashes = []
+    block_hashed = []
+    previous_mafd = 0
+    frame_count = 0
+    while True:
+        block_count = read_frames(stream, frames[1:])
+        if block_count == 0:
+            break
+        mafd = np.abs(np.diff(frames[:block_count + 1].astype(np.int16), axis=0)).mean(axis=1)
+        if frame_count == 0:
+            # the first frame has no previous one
+            mafd[0] = 0
+        previous_mafds = np.concatenate(([previous_mafd], mafd[:-1]))
+        scores = np.clip(np.minimum(mafd, np.abs(mafd - previous_mafds)) / 100, 0, 1)
+
+        hashed = scores >= hash_floor
+        hashes = np.zeros(block_count, dtype=np.uint64)
+        for position in np.nonzero(hashed)[0]:
+            hashes[position] = pack_hash(hash_gray_frame(frames[position + 1].tobytes(), cut_borders))
+        block_scores.append(scores.astype(np.float32))
+        block_hashes.append(hashes)
+        block_hashed.append(hashed)
+
+        previous_mafd = mafd[-1]
+        frames[0] = frames[block_count]
+        frame_count += block_count
+
+    if frame_count == 0:
+        return {"scores": np.zeros(0, dtype=np.float32), "hashes": np.zeros(0, dtype=np.uint64), "hashed": np.zeros(0, dtype=bool)}
+    return {"scores": np.concatenate(block_scores), "hashes": np.concatenate(block_hashes), "hashed": np.concatenate(block_hashed)}
+
+# Score vector of a video (or of a segment, pts relative to its decode start) in a single pass on piped low resolution frames
+# cropped first with crop ("w:h:x:y", see detect_video_crop)
+def extract_frame_scores(video_path, output_folder, video_duration, ffmpeg_script, progress_label, segment=None, cut_borders=False, hash_floor=SCORE_HASH_FLOOR_PERCENTAGE / 100, crop=None):
+    os.makedirs(output_folder, exist_ok=True)
+    if segment is None:
+        ffmpeg_input = f"-i \"{video_path}\""
+        progress_duration = video_duration
+    else:
+        ffmpeg_input = f"-ss {segment['decode_start']} -t {segment['decode_duration']} -i \"{video_path}\""
+        progress_duration = segment['decode_duration']
+
+    # a constant metadata makes metadata=print write the pts of every frame, piped frames are never dropped or duplicated
+    pts_path = f"{output_folder}/pts.txt"
+    crop_filter = f"crop={crop}," if crop else ""
+    ffmpeg_cmd = (
+        f"{ffmpeg_script} -loglevel quiet {FFMPEG_STDERR_PROGRESS_ARGS} {ffmpeg_input} "
+        f"-filter_complex \"{crop_filter}scale={HASH_FRAME_SIZE}:{HASH_FRAME_SIZE},format=gray,metadata=add:key=scored:value=1,metadata=print:file={pts_path}\" "
+        f"-vsync passthrough -f rawvideo pipe:1"
+    )
+    frame_scores = {}
+    run_ffmpeg_with_progress(ffmpeg_cmd, progress_label, progress_duration, stdout_reader=lambda stream: frame_scores.update(score_raw_gray_frames(stream, cut_borders, hash_floor)))
+
+    pts = []
+    if os.path.isfile(pts_path):
+        with open(pts_path, "r") as pts_file:
+            for line in pts_file:
+                match = SCENE_LINE_REGEX.match(line)
+                if match:
+                    pts.append(int(match.group(2)))
+        os.remove(pts_path)
+
+    frame_count = min(len(pts), len(frame_scores['scores']))
+    return {
+        "pts": np.array(pts[:frame_count], dtype=np.int64),
+        "scores": frame_scores['scores'][:frame_count],
+        "hashes": frame_scores['hashes'][:frame_count],
+        "hashed": frame_scores['hashed'][:frame_count],
+        "hash_floor": np.float64(hash_floor),
+    }
+
+# Score vector of the whole video, the segments are decoded at the same time and joined like in stitch_segments_scene_frames
+def extract_video_frame_scores(video_path, output_folder, video_tbn, video_fps, video_duration, segments, overlap, max_workers, ffmpeg_script, progress_label, cut_borders=False, hash_floor=SCORE_HASH_FLOOR_PERCENTAGE / 100, crop=None):
+    if segments <= 1:
+        return extract_frame_scores(video_path, output_folder, video_duration, ffmpeg_script, progress_label, cut_borders=cut_borders, hash_floor=hash_floor, crop=crop)
+
+    video_segments = split_in_segments(video_duration, segments, overlap)
+    segments_scores = run_parallel(extract_frame_scores, [
+        dict(
+            video_path=video_path,
+            output_folder=segment_folder(output_folder, segment),
+            video_duration=video_duration,
+            ffmpeg_script=ffmpeg_script,
+            progress_label=f"{progress_label} {segment['index'] + 1}/{segments}",
+            segment=segment,
+            cut_borders=cut_borders,
+            hash_floor=hash_floor,
+            crop=crop
+        ) for segment in video_segments
+    ], max_workers=max_workers)
+
+    # Rebase the PTS of every segment on the full video and keep only the frames inside the segment owned range
+    parts = {"pts": [], "scores": [], "hashes": [], "hashed": []}
+    for segment, frame_scores in zip(video_segments, segments_scores):
+        pts = frame_scores['pts'] + round(segment['decode_start'] * video_tbn)
+        owned = (pts / video_tbn >= segment['own_start']) & (pts / video_tbn < segment['own_end'])
+        parts['pts'].append(pts[owned])
+        for name in ('scores', 'hashes', 'hashed'):
+            parts[name].append(frame_scores[name][owned])
+        shutil.rmtree(segment_folder(output_folder, segment), ignore_errors=True)
+    frame_scores = {name: np.concatenate(values) for name, values in parts.items()}
+
+    # Rounding of the seek position can still make the same frame appear in two segments: less than half a frame apart
+    unique = np.concatenate(([True], np.diff(frame_scores['pts']) >= video_tbn / video_fps / 2))
+    frame_scores = {name: values[unique] for name, values in frame_scores.items()}
+    frame_scores['hash_floor'] = np.float64(hash_floor)
+    return frame_scores
+
+# Write time.txt in output_folder with the frames scoring more than frame_diff, as if they came from a single ffmpeg run
+def scene_frames_from_scores(output_folder, frame_scores, frame_diff, video_tbn):
+    scenes = []
+    with open(f"{output_folder}/time.txt", "w") as time_file:
+        for scene_frame_index, position in enumerate(np.nonzero(frame_scores['scores'] > frame_diff / 100)[0]):
+            pts = int(frame_scores['pts'][position])
+            pts_time = pts / video_tbn
+            time_file.write(f"frame:{scene_frame_index} pts:{pts} pts_time:{pts_time}\n")
+            scenes.append({
+                "scene_frame_index": scene_frame_index,
+                "pts": pts,
+                "pts_time": pts_time,
+                "hash": imagehash.hex_to_hash(f"{int(frame_scores['hashes'][position]):016x}") if frame_scores['hashed'][position] else None,
+            })
+    return scenes
+
+# Expression of the frames less than tolerance away from one of the sorted pts (pts_name is the pts variable of the
+# filter): a binary search on pts, leaf(position) is the expression of the frames near pts_list[position]
+# every frame is compared with log2(len(pts_list)) values instead of all of them
+def pts_search_expression(pts_list, tolerance, pts_name, leaf, first=0, last=None):
+    last = len(pts_list) if last is None else last
+    if last - first == 1:
+        return leaf(first)
+    middle = (first + last) // 2
+    return f"if(lt({pts_name},{pts_list[middle] - tolerance}),{pts_search_expression(pts_list, tolerance, pts_name, leaf, first, middle)},{pts_search_expression(pts_list, tolerance, pts_name, leaf, middle, last)})"
+
+# img%05d.jpg previews of the scene frames, written by a single ffmpeg run selecting their pts (within half a frame, the
+# pts of a segmented scan are rebased on the full video)
+# the pts of a selected frame is replaced by its image number, so a scene frame that is not found never shifts the names
+# of the next ones
+def extract_scene_previews(video_path, output_folder, scenes, preview_width, ffmpeg_script, video_tbn, video_fps, video_duration, progress_label, crop=None):
+    if not scenes:
+        return
+    pts_list = [scene['pts'] for scene in scenes]
+    tolerance = video_tbn / video_fps / 2
+    # a scene is selected once (variable 0 keeps the last image number), the image numbers keep increasing
+    select_expression = pts_search_expression(pts_list, tolerance, 'pts', lambda position: f"if(lt(abs(pts-{pts_list[position]}),{tolerance})*not(eq(ld(0),{scenes[position]['scene_frame_index'] + 1})),st(0,{scenes[position]['scene_frame_index'] + 1}),0)")
+    number_expression = pts_search_expression(pts_list, tolerance, 'PTS', lambda position: f"{scenes[position]['scene_frame_index'] + 1}")
+    crop_filter = f",crop={crop}" if crop else ""
+    filter_path = f"{output_folder}/{PREVIEW_FILTER_FILE}"
+    with open(filter_path, "w") as filter_file:
+        filter_file.write(f"select='{select_expression}',setpts='{number_expression}'{crop_filter},scale={preview_width}:-2")
+    # fixed quality: the bitrate control of the jpeg encoder would see the image numbers as a very high frame rate
+    ffmpeg_cmd = (
+        f"{ffmpeg_script} -loglevel quiet -y {FFMPEG_PROGRESS_ARGS} -i \"{video_path}\" "
+        f"-filter_script:v \"{filter_path}\" -vsync passthrough -frame_pts 1 -q:v 2 \"{output_folder}/img%05d.jpg\""
+    )
+    run_ffmpeg_with_progress(ffmpeg_cmd, f"{progress_label} previews", video_duration)
+    os.remove(filter_path)
+    missing = sum(1 for scene in scenes if not os.path.isfile(f"{output_folder}/img{scene['scene_frame_index'] + 1:05d}.jpg"))
+    if missing:
+        print(f"[{progress_label}] {missing} scene frames have no preview")
+
+# Same output of extract_scene_frames with stream_hashes, found on the score vector of the video: the vector is kept in
+# cache_dir (if given), a run with another frame_diff never decodes the video again
+def extract_scene_frames_from_scores(video_path, output_folder, frame_diff, video_tbn, video_fps, video_duration, segments, overlap, max_workers, ffmpeg_script, progress_label, preview_width=0, cut_borders=False, cache_dir="", cache_max_bytes=0, crop=None):
+    os.makedirs(output_folder, exist_ok=True)
+    cache_key = frame_cache_key(video_path, detector='scores', cut_borders=cut_borders, crop=crop)
+    # without cache_dir the vector of the last video is kept in output_folder
+    frame_scores = load_score_cache(cache_dir, cache_key) if cache_dir else load_folder_scores(output_folder, cache_key)
+    if frame_scores is not None and frame_diff / 100 < frame_scores['hash_floor']:
+        # the scene frames below the floor have not been hashed
+        frame_scores = None
+
+    if frame_scores is None:
+        hash_floor = min(SCORE_HASH_FLOOR_PERCENTAGE, frame_diff) / 100
+        frame_scores = extract_video_frame_scores(video_path, output_folder, video_tbn, video_fps, video_duration, segments, overlap, max_workers, ffmpeg_script, progress_label, cut_borders, hash_floor, crop)
+        if cache_dir:
+            store_score_cache(cache_dir, cache_key, frame_scores, cache_max_bytes)
+        else:
+            store_folder_scores(output_folder, cache_key, frame_scores)
+
+    scenes = scene_frames_from_scores(output_folder, frame_scores, frame_diff, video_tbn)
+    print(f"[{progress_label}] {len(scenes)} scene frames out of {len(frame_scores['pts'])} scored frames")
+    if preview_width:
+        extract_scene_previews(video_path, output_folder, scenes, preview_width, ffmpeg_script, video_tbn, video_fps, video_duration, progress_label, crop)
+    return scenes
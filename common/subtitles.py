@@ -0,0 +1,88 @@
+import numpy as np
+import os
+import pysubs2
+import sys
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+
+# files retimed when a folder is given, the retimed copies (<subtitle>.srt) are skipped
+SUBTITLE_EXTENSIONS = ('.srt', '.ass', '.ssa', '.vtt', '.sub')
+
+# [MS SOURCE, MS TARGET] pairs plus the start and end ones
+def complete_subtitle_timecodes(pair_timecodes, source_duration):
+    timecodes = [list(pair) for pair in pair_timecodes]
+
+    # Initial timecode to cut off the beginning
+    new_start_timecode = timecodes[0][0] - timecodes[0][1]
+    timecodes.insert(0, [new_start_timecode, 1])
+
+    # Final timecode to keep the speed of the last safe segment until the end
+    timecodes_last_index = len(timecodes) - 1
+    last_safe_speed = (timecodes[timecodes_last_index][1] - timecodes[timecodes_last_index - 1][1]) / (timecodes[timecodes_last_index][0] - timecodes[timecodes_last_index - 1][0])
+    source_end = source_duration * 1000 # sec to ms
+    new_end = ((source_end - timecodes[timecodes_last_index][0]) * last_safe_speed) + timecodes[timecodes_last_index][1]
+    timecodes.append([source_end - 1, new_end - 1])
+
+    return timecodes
+
+# [MS SOURCE, MS TARGET] rows sorted by source time, built once for all the subtitle files
+def build_retime_table(pairs):
+    table = np.array(pairs, dtype=np.float64).reshape(-1, 2)
+    return table[np.argsort(table[:, 0], kind='stable')]
+
+# Every time interpolated between the last row not after it and the next one, times outside the table are kept
+def retime_milliseconds(retime_table, times_ms):
+    times = np.asarray(times_ms, dtype=np.float64)
+    positions = np.searchsorted(retime_table[:, 0], times, side='right')
+    inside = (positions > 0) & (positions < len(retime_table))
+    lower = retime_table[np.clip(positions - 1, 0, len(retime_table) - 1)]
+    upper = retime_table[np.clip(positions, 0, len(retime_table) - 1)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        time_diff_ratio = (times - lower[:, 0]) / (upper[:, 0] - lower[:, 0])
+        target_times = lower[:, 1] + time_diff_ratio * (upper[:, 1] - lower[:, 1])
+    return np.where(inside, np.trunc(target_times), times).astype(np.int64)
+
+def process_subtitles(input_file, output_file, retime_table):
+    subs = pysubs2.load(input_file)
+
+    # start and end times of all the lines are interpolated at once
+    times_ms = retime_milliseconds(retime_table, [line.start for line in subs] + [line.end for line in subs])
+    for line, start_ms, end_ms in zip(subs, times_ms[:len(subs)], times_ms[len(subs):]):
+        line.start = int(start_ms)
+        line.end = int(end_ms)
+
+    # Save the modified subtitle file
+    subs.save(output_file)
+
+    return output_file
+
+# Subtitle files of paths, folders are replaced by the subtitle files they contain
+def expand_subtitle_paths(paths):
+    subtitle_paths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            subtitle_paths.append(path)
+            continue
+        for file in sorted(os.listdir(path)):
+            name, extension = os.path.splitext(file)
+            if extension.lower() in SUBTITLE_EXTENSIONS and os.path.splitext(name)[1].lower() not in SUBTITLE_EXTENSIONS:
+                subtitle_paths.append(os.path.join(path, file))
+    return subtitle_paths
+
+# Retime every subtitle file with the same timecodes, output files are forced to be srt
+# parsing and writing is pure python, files are retimed by max_workers processes (threads on Windows)
+def process_subtitle_files(input_files, pairs, max_workers):
+    retime_table = build_retime_table(pairs)
+    output_files = [input_file + '.srt' for input_file in input_files]
+    max_workers = min(max_workers, len(input_files))
+    if max_workers <= 1:
+        return [process_subtitles(input_file, output_file, retime_table) for input_file, output_file in zip(input_files, output_files)]
+    # a few files per task, a library of small files is not slowed down by the process round trips
+    chunk_size = max(1, len(input_files) // (4 * max_workers))
+    with fork_executor(max_workers) as executor:
+        return list(executor.map(process_subtitles, input_files, output_files, [retime_table] * len(input_files), chunksize=chunk_size))
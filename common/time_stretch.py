@@ -0,0 +1,337 @@
+import contextlib
+import hashlib
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+
+# parts of the time map stretching the audio more than this are silenced instead (the audio is not in the source)
+MAX_STRETCH_RATIO = 4
+# samples read from the decoder at once
+STRETCH_READ_BLOCK = 65536
+# length of the chunks stretched in parallel, their bounds are moved to the nearest anchors
+STRETCH_CHUNK_SECONDS = 30
+# Increase it when the stretched chunks change for the same time map
+STRETCH_CACHE_VERSION = 1
+
+def stretch_frame_size(sample_rate):
+    # ~40ms frames, a power of 2 for the FFTs
+    return 2 ** int(round(np.log2(sample_rate * 0.04)))
+
+# Time map of rubberband ("source sample" "output sample" lines) as two strictly increasing arrays of knots
+def build_time_map(timecodes):
+    source_knots = []
+    target_knots = []
+    for source_sample, target_sample in timecodes:
+        if source_knots and (source_sample <= source_knots[-1] or target_sample <= target_knots[-1]):
+            continue
+        source_knots.append(source_sample)
+        target_knots.append(target_sample)
+    return np.array(source_knots, dtype=np.float64), np.array(target_knots, dtype=np.float64)
+
+# Source position and stretch ratio of output positions: linear between the knots, same speed as the source outside them
+def map_output_positions(output_positions, source_knots, target_knots):
+    output_positions = np.asarray(output_positions, dtype=np.float64)
+    source_positions = np.interp(output_positions, target_knots, source_knots)
+    before = output_positions < target_knots[0]
+    after = output_positions > target_knots[-1]
+    source_positions[before] = source_knots[0] + output_positions[before] - target_knots[0]
+    source_positions[after] = source_knots[-1] + output_positions[after] - target_knots[-1]
+
+    ratios = np.ones(len(output_positions))
+    segments = np.searchsorted(target_knots, output_positions, side='right') - 1
+    inside = (segments >= 0) & (segments < len(target_knots) - 1)
+    segments = segments[inside]
+    ratios[inside] = (target_knots[segments + 1] - target_knots[segments]) / (source_knots[segments + 1] - source_knots[segments])
+    return source_positions, ratios
+
+class SourceBuffer:
+    # Sliding window over the decoded samples, positions before the start and after the end of the audio are silence
+    def __init__(self, read_block, channels, start=0):
+        self.read_block = read_block
+        self.channels = channels
+        self.samples = np.zeros((0, channels), dtype=np.float32)
+        self.start = start
+        self.ended = False
+
+    def get(self, first, last):
+        while not self.ended and self.start + len(self.samples) < last:
+            block = self.read_block(STRETCH_READ_BLOCK)
+            if len(block) == 0:
+                self.ended = True
+            else:
+                self.samples = np.concatenate((self.samples, block))
+        result = np.zeros((last - first, self.channels), dtype=np.float32)
+        copy_first = max(first, self.start)
+        copy_last = min(last, self.start + len(self.samples))
+        if copy_first < copy_last:
+            result[copy_first - first:copy_last - first] = self.samples[copy_first - self.start:copy_last - self.start]
+        return result
+
+    def discard_before(self, position):
+        if position > self.start:
+            drop = min(position - self.start, len(self.samples))
+            self.samples = self.samples[drop:]
+            self.start += drop
+
+def best_overlap_offset(template, region):
+    # position in region of the frame most similar to template (normalized cross correlation, computed with FFTs)
+    frame = len(template)
+    fft_size = 2 ** int(np.ceil(np.log2(len(region) + frame)))
+    correlation = np.fft.irfft(np.fft.rfft(region, fft_size) * np.conj(np.fft.rfft(template, fft_size)), fft_size)[:len(region) - frame + 1]
+    energy = np.concatenate(([0], np.cumsum(region.astype(np.float64) ** 2)))
+    frame_energy = energy[frame:] - energy[:-frame]
+    return int(np.argmax(correlation / np.sqrt(frame_energy + 1e-9)))
+
+# WSOLA time stretch following the time map: every output frame is taken near the source position given by the map,
+# where it best continues the previous frame; yields blocks of the output samples from output_start to output_end
+# read_block gives the source samples from source_start on
+def stretch_stream(read_block, channels, sample_rate, source_knots, target_knots, output_end, output_start=0, source_start=0):
+    frame = stretch_frame_size(sample_rate)
+    hop = frame // 2
+    tolerance = hop // 2
+    # periodic hann windows overlapping by half sum to 1
+    window = np.hanning(frame + 1)[:frame].astype(np.float32)[:, None]
+    source = SourceBuffer(read_block, channels, source_start)
+
+    frame_starts = np.arange(output_start - hop, output_end, hop)
+    centers, ratios = map_output_positions(frame_starts + hop, source_knots, target_knots)
+    nominal_positions = np.round(centers).astype(np.int64) - hop
+
+    output_tail = np.zeros((hop, channels), dtype=np.float32)
+    previous_position = None
+    for frame_start, nominal_position, ratio in zip(frame_starts.tolist(), nominal_positions.tolist(), ratios.tolist()):
+        if ratio > MAX_STRETCH_RATIO:
+            frame_samples = np.zeros((frame, channels), dtype=np.float32)
+            previous_position = None
+        else:
+            position = nominal_position
+            if previous_position is not None:
+                natural_position = previous_position + hop
+                template = source.get(natural_position, natural_position + frame).mean(axis=1)
+                region = source.get(nominal_position - tolerance, nominal_position + tolerance + frame).mean(axis=1)
+                position = nominal_position - tolerance + best_overlap_offset(template, region)
+            frame_samples = source.get(position, position + frame) * window
+            previous_position = position
+        source.discard_before(nominal_position - tolerance - frame)
+
+        if frame_start >= output_start:
+            yield (output_tail + frame_samples[:hop])[:output_end - frame_start]
+        output_tail = frame_samples[hop:]
+
+# stretch_stream of the output samples from output_start to output_end, reading only the needed part of the source audio
+def decode_and_stretch(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, output_start, output_end, audio_stream=0):
+    frame = stretch_frame_size(sample_rate)
+    source_positions, ratios = map_output_positions([output_start - frame, output_end + frame], source_knots, target_knots)
+    source_start = max(int(np.floor(source_positions[0])) - frame, 0)
+    source_end = max(int(np.ceil(source_positions[1])) + frame, source_start)
+    decoder_cmd = (
+        f"{ffmpeg_script} -loglevel quiet -ss {source_start / sample_rate} -i \"{source_path}\" -t {(source_end - source_start) / sample_rate} "
+        f"-map 0:a:{audio_stream} -f f32le -ac {channels} -ar {sample_rate} pipe:1"
+    )
+    sample_bytes = 4 * channels
+    decoder = subprocess.Popen(decoder_cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    decoded_samples = 0
+
+    def read_block(samples):
+        nonlocal decoded_samples
+        data = decoder.stdout.read(samples * sample_bytes)
+        data = data[:len(data) - len(data) % sample_bytes]
+        decoded_samples += len(data) // sample_bytes
+        return np.frombuffer(data, dtype=np.float32).reshape(-1, channels)
+
+    try:
+        yield from stretch_stream(read_block, channels, sample_rate, source_knots, target_knots, output_end, output_start, source_start)
+    finally:
+        decoder.stdout.close()
+        decoder.wait()
+    # the decoder is closed before the end of the audio when the output is shorter, its exit code does not matter then
+    if decoded_samples == 0 and decoder.returncode != 0:
+        raise RuntimeError(f"Audio decoder failed with exit code {decoder.returncode}: {decoder_cmd}")
+
+def render_stretch_chunk(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, output_start, output_end, audio_stream=0):
+    blocks = list(decode_and_stretch(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, output_start, output_end, audio_stream))
+    return np.concatenate(blocks) if blocks else np.zeros((0, channels), dtype=np.float32)
+
+# Output ranges of the chunks: a bound every chunk_samples, moved to the nearest anchor within a quarter of chunk, so
+# adding or removing an anchor only moves the bounds next to it
+def split_stretch_chunks(target_knots, output_samples, chunk_samples):
+    bounds = [0]
+    for grid_bound in range(chunk_samples, output_samples - chunk_samples // 2, chunk_samples):
+        near_knots = target_knots[np.abs(target_knots - grid_bound) <= chunk_samples // 4]
+        if len(near_knots):
+            grid_bound = int(round(near_knots[np.argmin(np.abs(near_knots - grid_bound))]))
+        bounds.append(grid_bound)
+    bounds.append(output_samples)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def stretch_chunk_key(source_path, sample_rate, channels, source_knots, target_knots, output_start, output_end, audio_stream=0):
+    # the chunk only depends on the source audio and on the knots around its output range
+    frame = stretch_frame_size(sample_rate)
+    first_knot = max(int(np.searchsorted(target_knots, output_start - frame, side='right')) - 1, 0)
+    last_knot = min(int(np.searchsorted(target_knots, output_end + frame, side='left')), len(target_knots) - 1)
+    stat = os.stat(source_path)
+    key_content = {
+        "version": STRETCH_CACHE_VERSION,
+        "source": [os.path.abspath(source_path), stat.st_size, stat.st_mtime_ns, audio_stream],
+        "format": [sample_rate, channels],
+        "range": [output_start, output_end],
+        "knots": [source_knots[first_knot:last_knot + 1].tolist(), target_knots[first_knot:last_knot + 1].tolist()],
+        # extrapolation before the first and after the last knot
+        "edges": [first_knot == 0, last_knot == len(target_knots) - 1],
+        "max_ratio": MAX_STRETCH_RATIO,
+    }
+    return hashlib.sha1(json.dumps(key_content, sort_keys=True).encode()).hexdigest()
+
+# Folder of cache_dir with the chunks of a render (same source, output and stream), the chunks of other renders sharing
+# cache_dir are never read or removed
+def stretch_render_folder(cache_dir, source_path, output_path, audio_stream=0):
+    render_content = json.dumps([os.path.abspath(source_path), os.path.abspath(output_path), audio_stream])
+    return os.path.join(cache_dir, 'stretch_' + hashlib.sha1(render_content.encode()).hexdigest()[:16])
+
+def load_stretch_chunk(chunk_file):
+    # None if the chunk is not cached (or has been removed since it was found)
+    try:
+        return np.load(chunk_file).astype(np.float32) / 32767
+    except (OSError, ValueError):
+        return None
+
+def save_stretch_chunk(chunk_file, samples):
+    # written to a temporary file first, a render running at the same time never reads a partial chunk
+    with open(chunk_file + '.tmp', 'wb') as tmp_file:
+        np.save(tmp_file, samples)
+    os.replace(chunk_file + '.tmp', chunk_file)
+
+def stretch_process_pool(max_workers):
+    # Worker processes for the chunks: the WSOLA loop holds the GIL at every hop, threads would not scale
+    # they are forked right away, create the pool before the track threads and their encoder pipes are started (a forked
+    # process would inherit their locks and their pipes) and share it between the tracks
+    executor = fork_executor(max_workers)
+    # a fork pool starts all its workers with the first job
+    executor.submit(int).result()
+    return executor
+
+# Chunks stretched in parallel, yielded in order with a crossfade of crossfade samples at every join
+# a chunk renders crossfade more samples than its range, faded out while the next chunk fades in
+# with cache_dir the chunks are kept as 16 bit samples (the precision of the wav output) and only the chunks whose
+# anchors changed since the last render of the same output are stretched again
+# executor is a pool of stretch_process_pool, without it the chunks run in max_workers threads
+def stretch_chunks(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, output_samples, max_workers, cache_dir='', audio_stream=0, output_path='', executor=None):
+    crossfade = stretch_frame_size(sample_rate)
+    chunks = split_stretch_chunks(target_knots, output_samples, max(STRETCH_CHUNK_SECONDS * sample_rate, 8 * crossfade))
+    # the last chunk has no following crossfade
+    chunks = [(start, end + crossfade if index < len(chunks) - 1 else end) for index, (start, end) in enumerate(chunks)]
+    chunk_files = [None] * len(chunks)
+    if cache_dir:
+        render_folder = stretch_render_folder(cache_dir, source_path, output_path, audio_stream)
+        os.makedirs(render_folder, exist_ok=True)
+        chunk_files = [os.path.join(render_folder, '{}.npy'.format(stretch_chunk_key(source_path, sample_rate, channels, source_knots, target_knots, start, end, audio_stream))) for start, end in chunks]
+    cached_chunks = sum(1 for chunk_file in chunk_files if chunk_file and os.path.isfile(chunk_file))
+    print(f"Stretching {len(chunks) - cached_chunks} of {len(chunks)} chunks with {max_workers} workers")
+    fade_in = np.linspace(0, 1, crossfade, dtype=np.float32)[:, None]
+    fade_out = 1 - fade_in
+
+    # a shared pool is left open for the other tracks
+    with contextlib.nullcontext(executor) if executor else ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # at most two chunks per worker are kept in memory
+        pending = deque()
+        next_chunk = 0
+        previous_tail = None
+        try:
+            for index in range(len(chunks)):
+                while next_chunk < len(chunks) and len(pending) < 2 * max_workers:
+                    start, end = chunks[next_chunk]
+                    chunk_file = chunk_files[next_chunk]
+                    if chunk_file and os.path.isfile(chunk_file):
+                        pending.append(None)
+                    else:
+                        pending.append(executor.submit(render_stretch_chunk, ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, start, end, audio_stream))
+                    next_chunk += 1
+                future = pending.popleft()
+                chunk_file = chunk_files[index]
+                if not chunk_file:
+                    samples = future.result()
+                else:
+                    samples = load_stretch_chunk(chunk_file) if future is None else None
+                    if samples is None:
+                        if future is None:
+                            # removed after it was found, stretched again here
+                            start, end = chunks[index]
+                            stretched = render_stretch_chunk(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, start, end, audio_stream)
+                        else:
+                            stretched = future.result()
+                        quantized = np.round(np.clip(stretched, -1, 1) * 32767).astype(np.int16)
+                        save_stretch_chunk(chunk_file, quantized)
+                        samples = quantized.astype(np.float32) / 32767
+
+                if previous_tail is not None:
+                    samples[:crossfade] = previous_tail * fade_out + samples[:crossfade] * fade_in
+                if index < len(chunks) - 1:
+                    previous_tail = samples[-crossfade:]
+                    samples = samples[:-crossfade]
+                yield samples
+        finally:
+            # chunks not joined yet when the output is closed early (shared pools keep running)
+            for future in pending:
+                if future is not None:
+                    future.cancel()
+
+    # chunks of older renders of this output are never used again, the folders of the other outputs are left untouched
+    if cache_dir:
+        for file in os.listdir(render_folder):
+            if file.endswith('.npy') and os.path.join(render_folder, file) not in chunk_files:
+                try:
+                    os.remove(os.path.join(render_folder, file))
+                except OSError:
+                    pass
+
+# Decode an audio stream of source_path (audio_stream 0 is the first one), stretch it following timecodes and encode it to
+# output_path in a single pass: no extracted or converted copy of the audio is written to disk
+# with more than one worker the audio is stretched in chunks at the same time, every chunk decodes its part of the source
+# with cache_dir only the chunks changed since the last render are stretched, executor is given to stretch_chunks
+def stretch_audio_stream(ffmpeg_script, source_path, sample_rate, channels, timecodes, output_samples, output_path, encoder_args, overwrite='', workers=1, cache_dir='', audio_stream=0, executor=None):
+    source_knots, target_knots = build_time_map(timecodes)
+    encoder_cmd = f"{ffmpeg_script}{overwrite} -loglevel quiet -f f32le -ac {channels} -ar {sample_rate} -i pipe:0 {encoder_args} \"{output_path}\""
+    print('--------------------------')
+    print(f"(decode and time stretch) | {encoder_cmd}")
+    print('--------------------------')
+
+    # decoders and encoder are a single job for the process slots
+    with process_slot():
+        encoder = subprocess.Popen(encoder_cmd, shell=True, stdin=subprocess.PIPE)
+        if workers <= 1 and not cache_dir:
+            blocks = decode_and_stretch(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, 0, output_samples, audio_stream)
+        else:
+            blocks = stretch_chunks(ffmpeg_script, source_path, sample_rate, channels, source_knots, target_knots, output_samples, workers, cache_dir, audio_stream, output_path, executor)
+
+        written_samples = 0
+        last_reported_step = -1
+        try:
+            for block in blocks:
+                encoder.stdin.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+                written_samples += len(block)
+                # report every 5%
+                step = int(written_samples / output_samples * 20)
+                if step > last_reported_step:
+                    last_reported_step = step
+                    print(f"[stretch {os.path.basename(output_path)}] {step * 5}%")
+        except RuntimeError as error:
+            print(error)
+            return 1
+        finally:
+            # the workers stop before the encoder input is closed
+            blocks.close()
+            encoder.stdin.close()
+            encoder.wait()
+    print(f"[stretch {os.path.basename(output_path)}] done")
+    return encoder.returncode
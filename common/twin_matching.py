@@ -0,0 +1,225 @@
+import numpy as np
+
+# rows of the distance matrix computed at the same time, keeps memory bounded with thousands of scenes per side
+TWIN_MATCHING_BLOCK_ROWS = 1024
+# any hamming distance between two 64 bit hashes is lower than this
+NO_TWIN_DISTANCE = 65
+
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def pack_hash(hash):
+    # 8x8 ImageHash to a single 64 bit integer (same bit order of str(hash))
+    return np.packbits(hash.hash.flatten()).view('>u8')[0]
+
+def pack_hashes(frame_infos):
+    if isinstance(frame_infos, np.ndarray):
+        # frame store (see frame_store.py), hashes are already packed
+        return np.ascontiguousarray(frame_infos['hash'])
+    return np.array([pack_hash(frame_info['hash']) for frame_info in frame_infos], dtype=np.uint64)
+
+def hashed_frame_infos(frame_infos):
+    # frames without a hash are left out of the matching, their hash 0 would be the twin of any dark or flat frame
+    if isinstance(frame_infos, np.ndarray):
+        return frame_infos[frame_infos['hashed']]
+    return [frame_info for frame_info in frame_infos if frame_info['hash'] is not None]
+
+def popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        # numpy >= 2.0
+        return np.bitwise_count(values)
+    return POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+# For every main hash, position of the brother hash with the lowest hamming distance (the first one in case of equal distance)
+# with search_window only brothers around the proportional position of the main hash are considered
+def find_nearest_hashes(main_hashes, brother_hashes, search_window=0):
+    main_count = len(main_hashes)
+    brother_count = len(brother_hashes)
+    positions = np.zeros(main_count, dtype=np.int64)
+    distances = np.zeros(main_count, dtype=np.uint8)
+    if main_count == 0 or brother_count == 0:
+        return positions, distances
+
+    brother_indexes = np.arange(brother_count)
+    for block_start in range(0, main_count, TWIN_MATCHING_BLOCK_ROWS):
+        block_hashes = main_hashes[block_start:block_start + TWIN_MATCHING_BLOCK_ROWS]
+        block_distances = popcount(np.bitwise_xor(block_hashes[:, None], brother_hashes[None, :]))
+        if search_window:
+            main_indexes = np.arange(block_start, block_start + len(block_hashes))
+            expected_positions = np.round(main_indexes * (brother_count - 1) / max(main_count - 1, 1))
+            outside_window = np.abs(brother_indexes[None, :] - expected_positions[:, None]) > search_window
+            block_distances[outside_window] = NO_TWIN_DISTANCE
+        block_positions = np.argmin(block_distances, axis=1)
+        positions[block_start:block_start + len(block_hashes)] = block_positions
+        distances[block_start:block_start + len(block_hashes)] = block_distances[np.arange(len(block_hashes)), block_positions]
+    return positions, distances
+
+# Reference implementation (one ImageHash subtraction per pair) kept to check and benchmark find_nearest_hashes
+def find_nearest_hashes_loop(main_frame_infos, brothers_frame_infos):
+    positions = []
+    distances = []
+    for main_frame_info in main_frame_infos:
+        best_position = None
+        best_distance = float('inf')
+        for position, brothers_frame_info in enumerate(brothers_frame_infos):
+            hamming_distance = main_frame_info['hash'] - brothers_frame_info['hash']
+            if hamming_distance < best_distance:
+                best_distance = hamming_distance
+                best_position = position
+        positions.append(best_position)
+        distances.append(best_distance)
+    return positions, distances
+
+# Same as find_nearest_hashes, but only brothers whose time is within window_seconds from the main frame time mapped on the
+# brother timeline are considered, the mapping is linear between the first and the last frames of each side (the anchors)
+# position is -1 when there is no brother inside the window
+def find_nearest_hashes_in_time(main_times, main_hashes, brother_times, brother_hashes, window_seconds):
+    main_count = len(main_hashes)
+    positions = np.full(main_count, -1, dtype=np.int64)
+    distances = np.full(main_count, NO_TWIN_DISTANCE, dtype=np.uint8)
+    if main_count == 0 or len(brother_hashes) == 0:
+        return positions, distances
+
+    main_times = np.asarray(main_times, dtype=np.float64)
+    brother_times = np.asarray(brother_times, dtype=np.float64)
+    main_duration = main_times[-1] - main_times[0]
+    speed = (brother_times[-1] - brother_times[0]) / main_duration if main_duration > 0 else 1
+    predicted_times = brother_times[0] + (main_times - main_times[0]) * speed
+
+    # sorted index of the brother times, candidates of every main frame are a contiguous slice of it
+    brother_order = np.argsort(brother_times, kind='stable')
+    sorted_brother_times = brother_times[brother_order]
+    sorted_brother_hashes = brother_hashes[brother_order]
+    window_starts = np.searchsorted(sorted_brother_times, predicted_times - window_seconds, side='left')
+    window_ends = np.searchsorted(sorted_brother_times, predicted_times + window_seconds, side='right')
+
+    for index in range(main_count):
+        window_start = window_starts[index]
+        window_end = window_ends[index]
+        if window_start == window_end:
+            continue
+        window_distances = popcount(np.bitwise_xor(sorted_brother_hashes[window_start:window_end], main_hashes[index]))
+        best = np.argmin(window_distances)
+        positions[index] = brother_order[window_start + best]
+        distances[index] = window_distances[best]
+    return positions, distances
+
+# cells of the full alignment matrix over which align_hashes_monotonic switches to the banded form (1 byte of traceback each)
+ALIGNMENT_MAX_FULL_CELLS = 100000000
+ALIGNMENT_DIAGONAL, ALIGNMENT_UP, ALIGNMENT_LEFT = 0, 1, 2
+
+def alignment_row_ranges(main_count, brother_count, band):
+    # 1-based brother columns [start, end] of every 1-based main row, around the line from (1, 1) to (main_count, brother_count)
+    if not band:
+        return [(1, brother_count)] * (main_count + 1)
+    # consecutive rows must overlap or the band would not contain a path
+    band = max(band, int(np.ceil(brother_count / main_count)) + 1)
+    ranges = [(0, 0)]
+    for row in range(1, main_count + 1):
+        expected = 1 + (row - 1) * (brother_count - 1) / max(main_count - 1, 1)
+        ranges.append((max(1, int(np.floor(expected - band))), min(brother_count, int(np.ceil(expected + band)))))
+    return ranges
+
+# Optimal monotonic alignment of two hash sequences (Needleman-Wunsch): matching two frames scores max_distance - distance,
+# leaving a frame without twin costs gap_penalty, returns the (main position, brother position, distance) of the matched
+# frames having distance lower than max_distance, both positions strictly increasing
+# with band only brothers within band positions from the diagonal are considered, memory is main_count * (2 * band + 1)
+def align_hashes_monotonic(main_hashes, brother_hashes, max_distance=10, gap_penalty=1, band=0):
+    main_count = len(main_hashes)
+    brother_count = len(brother_hashes)
+    if main_count == 0 or brother_count == 0:
+        return []
+    if not band and main_count * brother_count > ALIGNMENT_MAX_FULL_CELLS:
+        band = ALIGNMENT_MAX_FULL_CELLS // main_count // 2
+        print(f"Alignment matrix too big, using a band of {band} scenes")
+
+    row_ranges = alignment_row_ranges(main_count, brother_count, band)
+    columns = np.arange(brother_count + 1, dtype=np.float64)
+    # previous row of the score matrix, column 0 is the gap before the first brother
+    previous_row = -gap_penalty * columns
+    tracebacks = [None]
+    for row in range(1, main_count + 1):
+        start, end = row_ranges[row]
+        row_columns = columns[start:end + 1]
+        match_scores = max_distance - popcount(np.bitwise_xor(brother_hashes[start - 1:end], main_hashes[row - 1])).astype(np.float64)
+        diagonal = previous_row[start - 1:end] + match_scores
+        up = previous_row[start:end + 1] - gap_penalty
+        best = np.maximum(diagonal, up)
+        moves = np.where(diagonal >= up, ALIGNMENT_DIAGONAL, ALIGNMENT_UP).astype(np.uint8)
+
+        # H[j] = max(best[j], H[j - 1] - gap) unrolled as a cumulative max of best[k] + gap * k
+        before_start = -gap_penalty * row if start == 1 else -np.inf
+        chain = np.maximum.accumulate(np.concatenate(([before_start + gap_penalty * (start - 1)], best + gap_penalty * row_columns)))[1:]
+        current = chain - gap_penalty * row_columns
+        moves[current > best] = ALIGNMENT_LEFT
+
+        current_row = np.full(brother_count + 1, -np.inf)
+        current_row[start:end + 1] = current
+        if start == 1:
+            current_row[0] = before_start
+        previous_row = current_row
+        tracebacks.append(moves)
+
+    matches = []
+    row, column = main_count, brother_count
+    while row > 0 and column > 0:
+        start, end = row_ranges[row]
+        move = tracebacks[row][column - start]
+        if move == ALIGNMENT_DIAGONAL:
+            distance = int(popcount(np.bitwise_xor(main_hashes[row - 1:row], brother_hashes[column - 1:column]))[0])
+            if distance < max_distance:
+                matches.append((row - 1, column - 1, distance))
+            row -= 1
+            column -= 1
+        elif move == ALIGNMENT_UP:
+            row -= 1
+        else:
+            column -= 1
+    matches.reverse()
+    return matches
+
+# hashes with fewer or more bits set than this are almost uniform frames (black screens, fades) and are never anchors
+ANCHOR_MIN_BITS = 8
+ANCHOR_MAX_BITS = 56
+
+# Most reliable pair between main candidate positions and brother candidate positions, as
+# (main position, brother position, distance, confidence) or None if no pair is closer than max_distance
+# confidence goes from 0 (the second best brother is as near as the best one) to 1 (the best brother is identical and unique)
+def find_anchor_pair(main_hashes, brother_hashes, main_positions, brother_positions, max_distance=6):
+    main_positions = np.asarray(main_positions, dtype=np.int64)
+    brother_positions = np.asarray(brother_positions, dtype=np.int64)
+    if len(main_positions) == 0 or len(brother_positions) == 0:
+        return None
+
+    candidate_hashes = brother_hashes[brother_positions]
+    best_anchor = None
+    for main_position in main_positions:
+        bits = int(popcount(main_hashes[main_position:main_position + 1])[0])
+        if bits < ANCHOR_MIN_BITS or bits > ANCHOR_MAX_BITS:
+            continue
+        distances = popcount(np.bitwise_xor(candidate_hashes, main_hashes[main_position])).astype(np.int64)
+        best = np.argmin(distances)
+        if distances[best] > max_distance:
+            continue
+        second_distance = np.min(np.delete(distances, best)) if len(distances) > 1 else 64
+        confidence = (second_distance - distances[best]) / second_distance if second_distance > 0 else 0
+        if best_anchor is None or confidence > best_anchor[3]:
+            best_anchor = (int(main_position), int(brother_positions[best]), int(distances[best]), float(confidence))
+    return best_anchor
+
+# Safe start and end pairs chosen among the frames in the first and last edge_seconds of both sides
+def find_anchor_pairs(main_times, main_hashes, brother_times, brother_hashes, edge_seconds, max_distance=6):
+    main_times = np.asarray(main_times, dtype=np.float64)
+    brother_times = np.asarray(brother_times, dtype=np.float64)
+    start_anchor = find_anchor_pair(
+        main_hashes, brother_hashes,
+        np.flatnonzero(main_times <= main_times[0] + edge_seconds),
+        np.flatnonzero(brother_times <= brother_times[0] + edge_seconds),
+        max_distance
+    )
+    end_anchor = find_anchor_pair(
+        main_hashes, brother_hashes,
+        np.flatnonzero(main_times >= main_times[-1] - edge_seconds),
+        np.flatnonzero(brother_times >= brother_times[-1] - edge_seconds),
+        max_distance
+    )
+    return start_anchor, end_anchor
@@ -1,6 +1,28 @@
+import functools
+import io
+import json
+import multiprocessing
 import subprocess
 import platform
 import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+if platform.system() == 'Windows':
+    import msvcrt
+else:
+    import fcntl
+
+# channels of the ffmpeg layouts whose name is not made of channel counts ("5.1", "7.1.4") or channel names ("FL+FR+LFE")
+CHANNEL_LAYOUT_CHANNELS = {'mono': 1, 'stereo': 2, 'downmix': 2, 'quad': 4, 'hexagonal': 6, 'octagonal': 8, 'cube': 8, 'hexadecagonal': 16}
+
+# set by the batch driver: folder of the lock files and number of ffmpeg/rubberband processes allowed at the same time
+PROCESS_SLOTS_DIR_ENV = 'VIDEO_SYNC_PROCESS_SLOTS_DIR'
+PROCESS_SLOTS_ENV = 'VIDEO_SYNC_PROCESS_SLOTS'
 
 def open_folder(path):
     if platform.system() == 'Windows':
@@ -21,17 +43,200 @@ def delete_frame_cache_files(directory_path):
             file_path = os.path.join(directory_path, file)
             os.remove(file_path)
 
+# channels is None when ffprobe gives neither a channel count nor a known layout
+@dataclass(frozen=True)
+class AudioStreamMetadata:
+    index: int
+    codec: str
+    hz: int
+    channels: int
+
+def channel_layout_channels(channel_layout):
+    # channels of an ffmpeg layout ("5.1(side)", "stereo", "FL+FR+LFE"), None if unknown
+    name = channel_layout.split('(')[0]
+    if name in CHANNEL_LAYOUT_CHANNELS:
+        return CHANNEL_LAYOUT_CHANNELS[name]
+    if re.fullmatch(r'\d+(\.\d+)+', name):
+        return sum(int(count) for count in name.split('.'))
+    if '+' in channel_layout:
+        return len(channel_layout.split('+'))
+    return None
+
+@dataclass(frozen=True)
+class VideoMetadata:
+    path: str
+    duration: float
+    fps: float
+    tbn: int
+    width: int
+    height: int
+    audio_streams: tuple
+
+    # the scripts use the first audio stream, like "-select_streams a:0"
+    @property
+    def audio_hz(self):
+        return self.audio_streams[0].hz
+
+    @property
+    def audio_ext(self):
+        return self.audio_streams[0].codec
+
+@functools.lru_cache(maxsize=None)
+def probe_absolute_path(video_path):
+    print(f"Getting video information of {os.path.basename(video_path)} via ffprobe...")
+    probe_cmd = f"ffprobe -loglevel quiet -v error -show_streams -show_format -of json \"{video_path}\""
+    probe = json.loads(subprocess.check_output(probe_cmd, shell=True, universal_newlines=True))
+
+    streams = probe.get('streams', [])
+    video_stream = next(stream for stream in streams if stream['codec_type'] == 'video')
+    fps_numerator, fps_denominator = video_stream['r_frame_rate'].split('/')
+    duration = probe.get('format', {}).get('duration') or video_stream['duration']
+    audio_streams = tuple(
+        AudioStreamMetadata(
+            index=int(stream['index']),
+            codec=stream['codec_name'],
+            hz=int(stream['sample_rate']),
+            # the count is missing (or 0) for some codecs and containers, the layout can still tell it
+            channels=int(stream['channels']) if stream.get('channels') else channel_layout_channels(stream.get('channel_layout', ''))
+        ) for stream in streams if stream['codec_type'] == 'audio'
+    )
+    return VideoMetadata(
+        path=video_path,
+        duration=float(duration),
+        fps=round(float(fps_numerator) / float(fps_denominator), 3),
+        tbn=int(video_stream['time_base'].split('/')[1]),
+        width=int(video_stream.get('width', 0)),
+        height=int(video_stream.get('height', 0)),
+        audio_streams=audio_streams
+    )
+
+def probe_video(video_path):
+    # a single ffprobe run per video, its result is kept for the whole execution
+    return probe_absolute_path(os.path.abspath(video_path))
+
 def get_fps(video_path):
-    print('Getting video fps via ffprobe...')
-    fps_cmd = f"ffprobe -loglevel quiet -v error -select_streams v:0 -of default=noprint_wrappers=1:nokey=1 -show_entries stream=r_frame_rate \"{video_path}\""
-    fps = subprocess.check_output(fps_cmd, shell=True, universal_newlines=True)
-    fps_numerator = fps.strip().split('/')[0]
-    fps_denominator = fps.strip().split('/')[1]
-    return round(float(fps_numerator) / float(fps_denominator), 3)
+    return probe_video(video_path).fps
 
 def get_tbn(video_path):
-    print('Getting video tbn via ffprobe...')
-    tbn_cmd = f"ffprobe -loglevel quiet -v error -select_streams v:0 -of default=noprint_wrappers=1:nokey=1 -show_entries stream=time_base \"{video_path}\""
-    tbn = subprocess.check_output(tbn_cmd, shell=True, universal_newlines=True)
-    tbn_int_string = tbn.strip().split('/')[1]
-    return int(tbn_int_string)
+    return probe_video(video_path).tbn
+
+# ffmpeg options to add to a command executed by run_ffmpeg_with_progress
+FFMPEG_PROGRESS_ARGS = "-nostats -progress pipe:1"
+# same, but for commands using stdout for their output (run_ffmpeg_with_progress with stdout_reader)
+FFMPEG_STDERR_PROGRESS_ARGS = "-nostats -progress pipe:2"
+
+def report_ffmpeg_progress(progress_lines, label, duration=None):
+    last_reported_step = -1
+    for line in progress_lines:
+        key, _, value = line.strip().partition('=')
+        # lines are still read without a label, or ffmpeg would block on a full pipe
+        if label is None or key != 'out_time_us' or not value.isdigit():
+            continue
+        seconds = int(value) / 1000000
+        if duration:
+            # report every 5%
+            percentage = min(seconds / duration * 100, 100)
+            step = int(percentage // 5)
+            if step > last_reported_step:
+                last_reported_step = step
+                print(f"[{label}] {percentage:.0f}%")
+        else:
+            # report every minute of processed video
+            step = int(seconds // 60)
+            if step > last_reported_step:
+                last_reported_step = step
+                print(f"[{label}] {step} min processed")
+
+def try_lock_file(lock_file):
+    try:
+        if platform.system() == 'Windows':
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+@contextmanager
+def process_slot():
+    # Wait for one of the process slots shared by all the running jobs (no limit if not set by the batch driver)
+    # the operating system releases the lock of a crashed process, so a slot is never lost
+    slots_dir = os.environ.get(PROCESS_SLOTS_DIR_ENV)
+    if not slots_dir:
+        yield
+        return
+    slots = int(os.environ.get(PROCESS_SLOTS_ENV, '1'))
+    lock_file = None
+    while lock_file is None:
+        for slot in range(slots):
+            candidate = open(os.path.join(slots_dir, f"slot{slot}.lock"), 'a+')
+            if try_lock_file(candidate):
+                lock_file = candidate
+                break
+            candidate.close()
+        else:
+            time.sleep(0.5)
+    try:
+        yield
+    finally:
+        # closing the file releases the lock
+        lock_file.close()
+
+def run_process(command, **kwargs):
+    # subprocess.run of an ffmpeg/rubberband command counting on the process slots
+    with process_slot():
+        return subprocess.run(command, shell=True, **kwargs)
+
+def run_ffmpeg_with_progress(ffmpeg_cmd, label, duration=None, stdout_reader=None):
+    # Run an ffmpeg command (containing FFMPEG_PROGRESS_ARGS) reporting how far it got, prefixed by the label of the video
+    # with stdout_reader the command must contain FFMPEG_STDERR_PROGRESS_ARGS, the binary stdout is given to stdout_reader
+    # no stdin: ffmpeg running in the background would read the answers typed by the user
+    with process_slot():
+        if stdout_reader is None:
+            process = subprocess.Popen(ffmpeg_cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+            report_ffmpeg_progress(process.stdout, label, duration)
+        else:
+            process = subprocess.Popen(ffmpeg_cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            progress_thread = threading.Thread(target=report_ffmpeg_progress, args=(io.TextIOWrapper(process.stderr), label, duration))
+            progress_thread.start()
+            stdout_reader(process.stdout)
+            progress_thread.join()
+        process.wait()
+    if label is not None:
+        print(f"[{label}] done")
+    return process.returncode
+
+def run_parallel(function, kwargs_list, max_workers):
+    # Run the same function for every kwargs set, at most max_workers at the same time, results keep the input order
+    # NOTE: threads are enough because the heavy work happens inside the ffmpeg processes
+    if max_workers <= 1 or len(kwargs_list) <= 1:
+        return [function(**kwargs) for kwargs in kwargs_list]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(function, **kwargs) for kwargs in kwargs_list]
+        return [future.result() for future in futures]
+
+def fork_executor(max_workers):
+    # Executor for pure python work: processes are forked, a spawned process would run the whole script again (it is
+    # not guarded by __main__), where fork is not available (Windows) the work runs in threads
+    # NOTE: only use it when no other thread and no pipe to another process is open, the children inherit them
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def parse_pair_indexes(text):
+    # integers of a comma separated list, anything else is ignored
+    indexes = []
+    for num in text.split(','):
+        try:
+            indexes.append(int(num))
+        except ValueError:
+            pass
+    return indexes
+
+def write_status(status_file, status):
+    # Machine readable result of a non-interactive run: printed as the last line and saved in status_file (if any)
+    status_line = json.dumps(status)
+    print(status_line)
+    if status_file:
+        with open(status_file, 'w') as out_file:
+            out_file.write(status_line + "\n")
@@ -4,7 +4,6 @@
 import argparse
 import os
 import platform
-import re
 import subprocess
 import sys
 
@@ -12,79 +11,48 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
 if getattr(sys, 'frozen', False):
     # The application is running in a bundled form created by PyInstaller
     from common.utils import *
+    from common.scene_detection import *
+    from common.frame_store import *
+    from common.twin_matching import *
 else:
     # The application is running in a normal Python environment
     from utils import *
-
-def get_audio_hz(video_path):
-    print('Getting audio hz via ffprobe...')
-    hz_cmd = f"ffprobe -v error -select_streams a:0 -show_entries stream=sample_rate -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-    hz = subprocess.check_output(hz_cmd, shell=True, universal_newlines=True)
-    return int(hz)
-
-# Function to run FFmpeg command and capture frame information
-def capture_frame_info(video_path, output_folder, frame_diff, video_tbn, video_fps, video_pos_per_frame, edges_frame_search_minutes, ffmpeg_script):
-    print('Getting video new scene frame information via ffmpeg...')
-    # check just first and last edges_frame_search_minutes min (ex: 60 * 15 min = 900 seconds)
-    search_range = edges_frame_search_minutes * 60
-    ffmpeg_cmd = (
-        f"{ffmpeg_script} -loglevel quiet -ss 0 -i \"{video_path}\" -t {search_range} "
-        f"-filter_complex \"select='gt(scene,{frame_diff/100})',metadata=print:file={output_folder}/start_time.txt\" "
-        f"-vsync vfr \"{output_folder}/img%03d.jpg\""
-    )
-    subprocess.run(ffmpeg_cmd, shell=True)
-
-    matches = []
-    with open(f"{output_folder}/start_time.txt", "r") as time_file:
-        lines = time_file.readlines()
-        for index, line in enumerate(lines):
-            match = re.match(r'frame:(\d+)\s+pts:(\d+)\s+pts_time:(\d+.?\d*)', line)
-            if match:
-                matches.append(match)
-
-    duration_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-    duration = float(subprocess.check_output(duration_cmd, shell=True, universal_newlines=True))
-
-    approx_total_frames = duration * video_fps
-    start_of_end = round(approx_total_frames - (search_range * video_fps))
-
-    start_matches_len = len(matches)
-    ss_end_frame_search = duration - search_range
-    ffmpeg_cmd = (
-        f"{ffmpeg_script} -loglevel quiet -ss {ss_end_frame_search} -i \"{video_path}\" -t {search_range} "
-        f"-filter_complex \"select='gt(scene,{frame_diff/100})',metadata=print:file={output_folder}/end_time.txt\" "
-        f"-vsync vfr -start_number {len(matches)} \"{output_folder}/img%03d.jpg\""
-    )
-    print(ffmpeg_cmd) 
-    subprocess.run(ffmpeg_cmd, shell=True)
-
-    # Parse time.txt to capture frame information
+    from scene_detection import *
+    from frame_store import *
+    from twin_matching import *
+
+def exit_with_error(message, exit_code=1):
+    print(message)
+    if batch_mode:
+        write_status(status_file, {"status": "error", "exit_code": exit_code, "message": message})
+    sys.exit(exit_code)
+
+# Start and end windows of the video where scene changes are searched, the end one starts after the start one in short videos
+def edge_windows(video_duration, search_range):
+    start_window = build_segment(0, 0, min(search_range, video_duration), video_duration, 0)
+    end_window = build_segment(1, max(video_duration - search_range, start_window['own_end']), video_duration, video_duration, 0)
+    return [start_window, end_window]
+
+# Frame information of the scenes found in the edge windows, merged as if they came from a single ffmpeg run,
+# and the packed hashes of their frames (0 for a missing frame)
+def capture_frame_info(output_folder, windows, windows_scenes, video_tbn, video_fps, video_pos_per_frame):
+    scenes = stitch_segments_scene_frames(output_folder, windows, windows_scenes, video_tbn, video_fps)
+    hashes, hashed = pack_optional_hashes(hash_scene_images(output_folder, [scene['scene_frame_index'] for scene in scenes]))
     frame_info = []
-    with open(f"{output_folder}/end_time.txt", "r") as time_file:
-        lines = time_file.readlines()
-        for index, line in enumerate(lines):
-            match = re.match(r'frame:(\d+)\s+pts:(\d+)\s+pts_time:(\d+.?\d*)', line)
-            if match:
-                # + ss_end_frame_search * video_tbn
-                # + ss_end_frame_search
-                matches.append(match)
-
-    for index, match in enumerate(matches):
-        pts = int(match.group(2))
-        if index >= start_matches_len:
-            pts += round(ss_end_frame_search * video_tbn)
+    for scene in scenes:
+        pts = scene['pts']
         full_video_index = int(round(pts / video_pos_per_frame))
         frame_info.append({
-            "scene_frame_index": int(match.group(1)),
+            "scene_frame_index": scene['scene_frame_index'],
             "index": full_video_index,
             "second_index": round(full_video_index % video_fps),
             "pts": pts,
             "pts_s": pts / video_tbn,
             "pts_ms": pts / video_tbn * 1000,
-            "pts_time": float(match.group(3)) if index < start_matches_len else float(match.group(3)) + ss_end_frame_search
+            "pts_time": scene['pts_time']
         })
 
-    return frame_info
+    return frame_info, hashes
 
 parser = argparse.ArgumentParser(description='Adjusts audio duration based on 2 safe frame pairs of videos')
 
@@ -92,6 +60,11 @@ parser.add_argument("-sp", "--source-path", help="viddeo with wrong timing", def
 parser.add_argument("-tp", "--target-path", help="video with right timing", default="INPUT")
 parser.add_argument("-efsm", "--edges-frame-search-minutes", help="number of minutes at the beginning and end of videos to search for scene changes", type=int, default=15)
 parser.add_argument("-fdp", "--frame-diff-percentage", help="difference between frames to start a new scene", type=int, default=30)
+parser.add_argument("-ew", "--extraction-workers", help="number of edge windows (start and end of both videos) to extract scene frames from at the same time", type=int, default=4)
+parser.add_argument("-amxd", "--anchor-max-distance", help="maximum hamming distance of a safe pair chosen automatically", type=int, default=6)
+parser.add_argument("-amc", "--anchor-min-confidence", help="safe pairs chosen automatically with a lower confidence (from 0 to 1) are asked to the user instead", type=float, default=0.3)
+parser.add_argument("-b", "--batch", help="non-interactive run: the run fails instead of asking the safe pairs, no window is opened, an existing output is overwritten", action='store_true')
+parser.add_argument("-sf", "--status-file", help="batch mode: file where the json result of the run is written", default="")
 
 parser.add_argument("-ff",  "--ffmpeg", help="ffmpeg binary path", default='ffmpeg')
 
@@ -103,15 +76,18 @@ source_path = ARGS.source_path
 target_path = ARGS.target_path
 edges_frame_search_minutes = ARGS.edges_frame_search_minutes
 frame_diff_percentage = ARGS.frame_diff_percentage
+extraction_workers = ARGS.extraction_workers
+anchor_max_distance = ARGS.anchor_max_distance
+anchor_min_confidence = ARGS.anchor_min_confidence
+batch_mode = ARGS.batch
+status_file = ARGS.status_file
 
 # Check if source_path and target_path are valid video files
 if not os.path.isfile(source_path):
-    print(f"The source video file '{source_path}' does not exist.")
-    sys.exit(1)
+    exit_with_error(f"The source video file '{source_path}' does not exist.")
 
 if not os.path.isfile(target_path):
-    print(f"The target video file '{target_path}' does not exist.")
-    sys.exit(1)
+    exit_with_error(f"The target video file '{target_path}' does not exist.")
 
 # Define output folders for source and target frames
 source_frames_folder = "SOURCE_FRAMES"
@@ -125,57 +101,109 @@ os.makedirs(target_frames_folder, exist_ok=True)
 delete_frame_cache_files(source_frames_folder)
 delete_frame_cache_files(target_frames_folder)
 
+# Probe both videos at the same time
+source_metadata, target_metadata = run_parallel(probe_video, [dict(video_path=source_path), dict(video_path=target_path)], max_workers=2)
+
 # Get FPS and TBN for the source video
-source_fps = get_fps(source_path)
-source_tbn = get_tbn(source_path)
+source_fps = source_metadata.fps
+source_tbn = source_metadata.tbn
 source_pos_per_frame = source_tbn / source_fps
-source_audio_hz = get_audio_hz(source_path)
+source_audio_hz = source_metadata.audio_hz
+source_duration = source_metadata.duration
 
 # Get FPS and TBN for the target video
-target_fps = get_fps(target_path)
-target_tbn = get_tbn(target_path)
+target_fps = target_metadata.fps
+target_tbn = target_metadata.tbn
 target_pos_per_frame = int(round(target_tbn / target_fps))
+target_duration = target_metadata.duration
 
 # Print the FPS and TBN for both videos
 print('')
 print(f"Source video - FPS: {source_fps}, TBN: {source_tbn}, PPF: {source_pos_per_frame}")
 print(f"Target video - FPS: {target_fps}, TBN: {target_tbn}, PPF: {target_pos_per_frame}", end="\n\n")
 
-# Run FFmpeg commands and capture frame information for both videos
-source_frame_info = capture_frame_info(
-    video_path=source_path,
-    output_folder=source_frames_folder,
-    frame_diff=frame_diff_percentage,
-    video_tbn=source_tbn,
-    video_fps=source_fps,
-    video_pos_per_frame=source_pos_per_frame,
-    edges_frame_search_minutes=edges_frame_search_minutes,
-    ffmpeg_script=ffmpeg_script
+# Scan the start and end windows of both videos at the same time, the durations are the probed ones
+# check just first and last edges_frame_search_minutes min (ex: 60 * 15 min = 900 seconds)
+search_range = edges_frame_search_minutes * 60
+source_windows = edge_windows(source_duration, search_range)
+target_windows = edge_windows(target_duration, search_range)
+print("Getting video new scene frame information via ffmpeg...")
+windows_scenes = run_parallel(extract_scene_frames, [
+    dict(
+        video_path=video_path,
+        output_folder=segment_folder(frames_folder, window),
+        frame_diff=frame_diff_percentage,
+        video_duration=video_duration,
+        ffmpeg_script=ffmpeg_script,
+        progress_label=f"{label} {window_name}",
+        segment=window
+    )
+    for video_path, frames_folder, video_duration, label, windows in [
+        (source_path, source_frames_folder, source_duration, 'source', source_windows),
+        (target_path, target_frames_folder, target_duration, 'target', target_windows)
+    ]
+    for window_name, window in zip(['start', 'end'], windows)
+], max_workers=extraction_workers)
+
+source_frame_info, source_hashes = capture_frame_info(source_frames_folder, source_windows, windows_scenes[:2], source_tbn, source_fps, source_pos_per_frame)
+target_frame_info, target_hashes = capture_frame_info(target_frames_folder, target_windows, windows_scenes[2:], target_tbn, target_fps, target_pos_per_frame)
+
+print('')
+# Safe pairs are the most reliable matching frames of the start and end windows, the end frames are tried from the last
+# one: among equally reliable pairs the farthest apart give the most precise speed
+source_end_start = source_windows[1]['own_start']
+target_end_start = target_windows[1]['own_start']
+start_anchor = find_anchor_pair(
+    source_hashes, target_hashes,
+    [index for index, frame in enumerate(source_frame_info) if frame['pts_s'] < source_end_start],
+    [index for index, frame in enumerate(target_frame_info) if frame['pts_s'] < target_end_start],
+    anchor_max_distance
 )
-target_frame_info = capture_frame_info(
-    video_path=target_path,
-    output_folder=target_frames_folder,
-    frame_diff=frame_diff_percentage,
-    video_tbn=target_tbn,
-    video_fps=target_fps,
-    video_pos_per_frame=target_pos_per_frame,
-    edges_frame_search_minutes=edges_frame_search_minutes,
-    ffmpeg_script=ffmpeg_script
+end_anchor = find_anchor_pair(
+    source_hashes, target_hashes,
+    [index for index, frame in reversed(list(enumerate(source_frame_info))) if frame['pts_s'] >= source_end_start],
+    [index for index, frame in reversed(list(enumerate(target_frame_info))) if frame['pts_s'] >= target_end_start],
+    anchor_max_distance
+)
+confident_anchors = (
+    start_anchor is not None and end_anchor is not None
+    and min(start_anchor[3], end_anchor[3]) >= anchor_min_confidence
+    and start_anchor[0] < end_anchor[0] and start_anchor[1] < end_anchor[1]
 )
 
-open_folder(source_frames_folder)
-open_folder(target_frames_folder)
+if confident_anchors:
+    source_start_frame, target_start_frame, start_distance, start_confidence = start_anchor
+    source_end_frame, target_end_frame, end_distance, end_confidence = end_anchor
+    print(f"Safe start pair: source {source_start_frame + 1}, target {target_start_frame + 1} (distance {start_distance}, confidence {start_confidence:.2f})")
+    print(f"Safe end pair: source {source_end_frame + 1}, target {target_end_frame + 1} (distance {end_distance}, confidence {end_confidence:.2f})")
+    print("\n")
+else:
+    if batch_mode:
+        exit_with_error("No confident safe start and end frame pairs found, try a bigger --anchor-max-distance or a smaller --anchor-min-confidence", 2)
+    print("No confident safe start and end frame pairs found, choose them manually")
 
-print('')
-# Prompt the user to input the start frame index for the source video
-source_start_frame = input("Check the {0} directory and enter the start frame number for the source video: ".format(source_frames_folder))
-# Prompt the user to input the start frame index for the target video
-target_start_frame = input("Check the {0} directory and enter the start frame number for the target video: ".format(target_frames_folder))
-print("\n")
+    open_folder(source_frames_folder)
+    open_folder(target_frames_folder)
+
+    # Prompt the user to input the start frame index for the source video
+    source_start_frame = input("Check the {0} directory and enter the start frame number for the source video: ".format(source_frames_folder))
+    # Prompt the user to input the start frame index for the target video
+    target_start_frame = input("Check the {0} directory and enter the start frame number for the target video: ".format(target_frames_folder))
+    print("\n")
+
+    # Convert the input values to integers
+    source_start_frame = int(source_start_frame) - 1
+    target_start_frame = int(target_start_frame) - 1
+
+    # Prompt the user to input the end frame index for the source video
+    source_end_frame = input("Enter the end frame number for the source video: ")
+    # Prompt the user to input the end frame index for the target video
+    target_end_frame = input("Enter the end frame number for the target video: ")
+    print("\n")
 
-# Convert the input values to integers
-source_start_frame = int(source_start_frame) - 1
-target_start_frame = int(target_start_frame) - 1
+    # Convert the input values to integers, end frames are numbered like the start ones
+    source_end_frame = int(source_end_frame) - 1
+    target_end_frame = int(target_end_frame) - 1
 
 print("Source video safe start frame info:")
 print(source_frame_info[source_start_frame])
@@ -183,16 +211,6 @@ print("Target video safe start frame info:")
 print(target_frame_info[target_start_frame])
 print("\n")
 
-# Prompt the user to input the end frame index for the source video
-source_end_frame = input("Enter the end frame index for the source video: ")
-# Prompt the user to input the end frame index for the target video
-target_end_frame = input("Enter the end frame index for the target video: ")
-print("\n")
-
-# Convert the input values to integers
-source_end_frame = int(source_end_frame)
-target_end_frame = int(target_end_frame)
-
 print("Source video safe end frame info:")
 print(source_frame_info[source_end_frame])
 print("Target video safe end frame info:")
@@ -214,51 +232,67 @@ start_delta = (target_frame_info[target_start_frame]["pts_ms"] - (retimed_start)
 print("I'm going to run this command, but you can copy-paste it to run it yourself:", end="\n\n")
 
 output_audio_ext = 'opus'
+output_audio_path = '{}_synced.{}'.format(os.path.splitext(target_path)[0], output_audio_ext)
 OPUS_WORKAROUND = ", aformat=channel_layouts=7.1|5.1|stereo"
+# without a terminal ffmpeg cannot ask before overwriting an existing output
+ffmpeg_overwrite = ' -y' if batch_mode else ''
 
 if start_delta > 0:
     ffmpeg_delta_positive_command = (
-        '{ffmpeg} -i \"{source_path}\" -filter_complex '
+        '{ffmpeg}{overwrite} -i \"{source_path}\" -filter_complex '
         '"[0:a]rubberband=tempo={speed_delta}{opus_workaround}[a1]; '
-        ' [a1]adelay={start_delta}|{start_delta}[aout]" -map "[aout]" -ar {source_audio_hz} -c:a libopus \"{output_name}_synced.{output_audio_ext}\"'
+        ' [a1]adelay={start_delta}|{start_delta}[aout]" -map "[aout]" -ar {source_audio_hz} -c:a libopus \"{output_audio_path}\"'
     ).format(
         ffmpeg = ffmpeg_script,
+        overwrite = ffmpeg_overwrite,
         source_path = source_path,
         speed_delta = speed_delta,
         opus_workaround = OPUS_WORKAROUND,
         start_delta = start_delta,
         source_audio_hz = 48000 if source_audio_hz == 44100 else source_audio_hz,
-        output_name = os.path.splitext(target_path)[0],
-        output_audio_ext = output_audio_ext
+        output_audio_path = output_audio_path
     )
 
     print(ffmpeg_delta_positive_command, end="\n\n")
 
-    subprocess.run(ffmpeg_delta_positive_command, shell=True)
+    ffmpeg_result = subprocess.run(ffmpeg_delta_positive_command, shell=True, stdin=subprocess.DEVNULL if batch_mode else None)
 else:
     ffmpeg_delta_negative_command = (
-        '{ffmpeg} -i \"{source_path}\" -filter_complex '
-        '"[0:a]rubberband=tempo={speed_delta}{opus_workaround}[a1]" -map "[a1]" -ss {start_delta}ms -ar {source_audio_hz} -c:a libopus \"{output_name}_synced.{output_audio_ext}\"'
+        '{ffmpeg}{overwrite} -i \"{source_path}\" -filter_complex '
+        '"[0:a]rubberband=tempo={speed_delta}{opus_workaround}[a1]" -map "[a1]" -ss {start_delta}ms -ar {source_audio_hz} -c:a libopus \"{output_audio_path}\"'
     ).format(
         ffmpeg = ffmpeg_script,
+        overwrite = ffmpeg_overwrite,
         source_path = source_path,
         speed_delta = speed_delta,
         opus_workaround = OPUS_WORKAROUND,
         start_delta = abs(start_delta),
         source_audio_hz = 48000 if source_audio_hz == 44100 else source_audio_hz,
-        output_name = os.path.splitext(target_path)[0],
-        output_audio_ext = output_audio_ext
+        output_audio_path = output_audio_path
     )
 
     print(ffmpeg_delta_negative_command, end="\n\n")
 
-    subprocess.run(ffmpeg_delta_negative_command, shell=True)
+    ffmpeg_result = subprocess.run(ffmpeg_delta_negative_command, shell=True, stdin=subprocess.DEVNULL if batch_mode else None)
 
-open_folder(os.path.dirname(target_path))
+if ffmpeg_result.returncode != 0:
+    exit_with_error(f"ffmpeg failed with exit code {ffmpeg_result.returncode}, '{output_audio_path}' has not been written", 3)
+
+if not batch_mode:
+    open_folder(os.path.dirname(target_path))
 
 # Clean frame directories?
-clean_frame_dir = input("Do you want to clean frame directories? [Y/N]: ")
+clean_frame_dir = 'y' if batch_mode else input("Do you want to clean frame directories? [Y/N]: ")
 
 if clean_frame_dir.lower() == 'y':
     delete_frame_cache_files(source_frames_folder)
     delete_frame_cache_files(target_frames_folder)
+
+if batch_mode:
+    write_status(status_file, {
+        "status": "ok",
+        "exit_code": 0,
+        "output": output_audio_path,
+        "source_anchors": [source_start_frame + 1, source_end_frame + 1],
+        "target_anchors": [target_start_frame + 1, target_end_frame + 1]
+    })
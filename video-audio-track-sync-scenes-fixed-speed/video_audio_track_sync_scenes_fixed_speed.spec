@@ -6,7 +6,7 @@ a = Analysis(
     pathex=['..'],
     binaries=[],
     datas=[('../common/', 'common')],
-    hiddenimports=['common.utils'],
+    hiddenimports=['common.utils', 'common.scene_detection', 'common.frame_store', 'common.twin_matching'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
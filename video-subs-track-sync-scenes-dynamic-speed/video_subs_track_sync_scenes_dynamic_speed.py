@@ -3,153 +3,46 @@
 
 import argparse
 import glob
-import imagehash
 import math
 import os
 import platform
-import pysubs2
-import re
 import subprocess
 import sys
 import webbrowser
-from PIL import Image
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
 if getattr(sys, 'frozen', False):
     # The application is running in a bundled form created by PyInstaller
     from common.utils import *
+    from common.scene_detection import *
+    from common.scene_scores import *
+    from common.frame_cache import *
+    from common.frame_store import *
+    from common.twin_matching import *
+    from common.scene_capture import *
+    from common.alignment import *
+    from common.subtitles import *
+    from common.audio_alignment import *
 else:
     # The application is running in a normal Python environment
     from utils import *
-
-def is_sorted(arr):
-    for i in range(len(arr) - 1):
-        if arr[i] > arr[i + 1]:
-            return False
-    return True
-
-def get_duration(video_path):
-    print('Getting video duration via ffprobe...')
-    duration_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-    duration = subprocess.check_output(duration_cmd, shell=True, universal_newlines=True)
-    return float(duration)
-
-def get_audio_ext(video_path):
-    print('Getting video audio extension via ffprobe...')
-    audio_ext_cmd = f"ffprobe -v error -select_streams a:0 -show_entries stream=codec_name -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-    audio_ext = subprocess.check_output(audio_ext_cmd, shell=True, universal_newlines=True)
-    return audio_ext.strip()
-
-# Function to run FFmpeg command and capture frame information
-def capture_frame_info(video_path, output_folder, frame_diff, video_tbn, video_fps, video_pos_per_frame, ffmpeg_script):
-    print('Getting video new scene frame information via ffmpeg...')
-    ffmpeg_cmd = (
-        f"{ffmpeg_script} -loglevel quiet -i \"{video_path}\" "
-        f"-filter_complex \"select='gt(scene,{frame_diff/100})',metadata=print:file={output_folder}/time.txt\" "
-        f"-vsync vfr \"{output_folder}/img%05d.jpg\""
-    )
-    subprocess.run(ffmpeg_cmd, shell=True)
-
-    # Parse time.txt to capture frame information
-    frame_info = []
-    with open(f"{output_folder}/time.txt", "r") as time_file:
-        lines = time_file.readlines()
-        for index, line in enumerate(lines):
-            match = re.match(r'frame:(\d+)\s+pts:(\d+)\s+pts_time:(\d+.?\d*)', line)
-            if match:
-                pts = int(match.group(2))
-                full_video_index = int(round(pts / video_pos_per_frame))
-                scene_frame_index = int(match.group(1))
-                frame_index_in_its_second = round(full_video_index % video_fps)
-
-                hash = None
-                try:
-                    # NOTE: file names start from 1, not 0 like the index
-                    img = Image.open('{}/img{:05d}.jpg'.format(output_folder, scene_frame_index + 1))
-                    hash = imagehash.average_hash(img)
-                except FileNotFoundError as e:
-                    pass
-
-                frame_info.append({
-                    "scene_frame_index": scene_frame_index,
-                    "index": full_video_index,
-                    "second_index": frame_index_in_its_second,
-                    "pts": pts,
-                    "pts_s": pts / video_tbn,
-                    "pts_ms": pts / video_tbn * 1000,
-                    "pts_time": float(match.group(3)),
-                    "hash": hash
-                })
-
-    return frame_info
-
-def find_twin_frames(main_frame_infos, brothers_frame_infos, reverse_main_and_twin = False):
-    pairs = []
-    for main_frame_infos in main_frame_infos:
-        current_pair = {'main': main_frame_infos['scene_frame_index'], 'twin': None, 'distance': float('inf') }
-        for brothers_frame_info in brothers_frame_infos:
-            hamming_distance = main_frame_infos['hash'] - brothers_frame_info['hash']
-            if hamming_distance < current_pair['distance']:
-                current_pair['distance'] = hamming_distance
-                current_pair['twin'] = brothers_frame_info['scene_frame_index']
-        pairs.append(current_pair)
-
-    # remove bad twins
-    # - twin appearing multiple times
-    # - twin not in order
-    double_twin_indexes = {}
-    bad_indexes = []
-
-    # bad side AFTER the reversing
-    # the "bad" side is always the one with the most frames
-    # if it is the source it will be main (because AFTER reversal it is main)
-    # if it is the target it will be twin (because AFTER reversal it is twin)
-    possibly_bad_side = 'main' if reverse_main_and_twin else 'twin'
-    
-    for index, pair in enumerate(pairs):
-        # if requested to use twin as main
-        if reverse_main_and_twin:
-            print('reversing', pair['twin'], 'and replacing it with', pair['main'])
-            print(pair)
-            temp_twin = pair['twin']
-            pair['twin'] = pair['main']
-            pair['main'] = temp_twin
-        
-        # count frame appearance (will use it to find double appearance)
-        if pair[possibly_bad_side] not in double_twin_indexes:
-            double_twin_indexes[pair[possibly_bad_side]] = []
-        double_twin_indexes[pair[possibly_bad_side]].append(index)
-   
-    # remove twin appearing multiple times
-    for value in double_twin_indexes.values():
-        if len(value) > 1:
-            print(f"Same frame indexes: {value}")
-            bad_indexes += value
-        
-    for bad_index in sorted(bad_indexes, reverse=True):
-        pairs.pop(bad_index)
-
-    # NOTE this only works with 1 frame error groups, but I've never found bigger groups in my tests
-    bad_indexes = []
-    for index, pair in enumerate(pairs):
-        # a frame cannot have a lower index than the previous one
-        if index > 0 and pair[possibly_bad_side] < pairs[index - 1][possibly_bad_side]:
-            bad_indexes.append(index)
-        # a frame cannot have a higher index than the next one
-        if index < len(pairs) - 1 and pair[possibly_bad_side] > pairs[index + 1][possibly_bad_side]:
-            bad_indexes.append(index)
-    
-    for bad_index in sorted(bad_indexes, reverse=True):
-        pairs.pop(bad_index)
-
-    pairs_twin_indexes = [pair[possibly_bad_side] for pair in pairs if pair[possibly_bad_side] in pairs]
-    if not is_sorted(pairs_twin_indexes):
-        print('Found a case unhandled by the software: too much unordered groups of frames')
-        sys.exit(1)
-
-    return pairs
-
-def frame_index_to_timecodes(pairs, source_frame_infos, target_frame_infos, source_fps, taget_fps):
+    from scene_detection import *
+    from scene_scores import *
+    from frame_cache import *
+    from frame_store import *
+    from twin_matching import *
+    from scene_capture import *
+    from alignment import *
+    from subtitles import *
+    from audio_alignment import *
+
+def exit_with_error(message, exit_code=1):
+    print(message)
+    if batch_mode:
+        write_status(status_file, {"status": "error", "exit_code": exit_code, "message": message})
+    sys.exit(exit_code)
+
+def frame_index_to_timecodes(pairs, source_frame_infos, target_frame_infos, source_fps, target_fps):
     timecodes = []
     for pair in pairs:
         current_source_frame = source_frame_infos[pair['main']]
@@ -164,70 +57,43 @@ def frame_index_to_timecodes(pairs, source_frame_infos, target_frame_infos, sour
 
     return timecodes
 
-def find_bounds_and_interpolate(pairs, ms):
-    lower_pair = None
-    upper_pair = None
-
-    for pair in pairs:
-        if pair[0] <= ms:
-            lower_pair = pair
-        else:
-            upper_pair = pair
-            break
-
-    if not lower_pair or not upper_pair:
-        return None
-
-    # Calculate the interpolated target time
-    time_diff_ratio = (ms - lower_pair[0]) / (upper_pair[0] - lower_pair[0])
-    target_time = lower_pair[1] + time_diff_ratio * (upper_pair[1] - lower_pair[1])
-
-    return target_time
-
-def process_subtitles(input_file, output_file, pairs):
-    subs = pysubs2.load(input_file)
-
-    for line in subs:
-        # Get the start and end time in milliseconds
-        start_ms = line.start
-        end_ms = line.end
-
-        # Interpolate new timings
-        new_start_ms = find_bounds_and_interpolate(pairs, start_ms)
-        new_end_ms = find_bounds_and_interpolate(pairs, end_ms)
-
-        if new_start_ms is not None:
-            line.start = int(new_start_ms)
-        if new_end_ms is not None:
-            line.end = int(new_end_ms)
-
-    # Save the modified subtitle file
-    subs.save(output_file)
-
-    return output_file
-
-def describe_frame_infos(frame_dict):
-    description = {
-        'scene_frame_index': f"Scene Frame Index: {frame_dict['scene_frame_index']}",
-        'index': f"Index: {frame_dict['index']}",
-        'second_index': f"Index inside second: {frame_dict['second_index']}",
-        'pts': f"PTS (Timestamp): {frame_dict['pts']}",
-        'pts_s': f"PTS (Seconds): {frame_dict['pts_s']:.4f}",
-        'pts_ms': f"PTS (Milliseconds): {frame_dict['pts_ms']:.1f}",
-        'pts_time': f"PTS (Time): {frame_dict['pts_time']:.4f}",
-        'hash': f"Hash String: {str(frame_dict['hash'])}"
-    }
-
-    for key, value in description.items():
-        print(value)
-    print("----------------------------------")
-
 parser = argparse.ArgumentParser(description='Adjusts audio duration based on 2 safe frame pairs of videos')
 
 parser.add_argument("-sp", "--source-path", help="video with wrong timing", default="INPUT")
 parser.add_argument("-tp", "--target-path", help="video with right timing", default="INPUT")
-parser.add_argument("-ssp", "--source-sub-path", help="sub with wrong timing", default="INPUT")
+parser.add_argument("-ssp", "--source-sub-path", help="subs with wrong timing (or folders of them), all retimed with the same pairs", nargs='+', default=["INPUT"])
+parser.add_argument("-sw", "--subtitle-workers", help="number of subtitle files retimed at the same time (0 for one per cpu core)", type=int, default=0)
 parser.add_argument("-fdp", "--frame-diff-percentage", help="difference between frames to start a new scene", type=int, default=30)
+parser.add_argument("-ew", "--extraction-workers", help="number of videos to extract scene frames from at the same time", type=int, default=1)
+parser.add_argument("-sgs", "--scene-segments", help="number of time segments each video is split into for scene detection", type=int, default=1)
+parser.add_argument("-sgo", "--scene-segment-overlap", help="seconds of overlap between scene detection segments", type=float, default=2)
+parser.add_argument("-sgw", "--scene-segment-workers", help="number of scene detection segments processed at the same time (default: all)", type=int, default=0)
+parser.add_argument("-cd", "--cache-dir", help="folder where scene detection results are kept between runs (disabled if empty)", default="")
+parser.add_argument("-cmm", "--cache-max-mb", help="maximum size of the scene detection cache, least recently used videos are removed first", type=int, default=10240)
+parser.add_argument("-sh", "--stream-hashes", help="hash scene frames in memory from piped low resolution frames instead of full size jpg files", action='store_true')
+parser.add_argument("-pvw", "--preview-width", help="width of the scene frame previews written with --stream-hashes or --scene-detector scores (0 to skip them)", type=int, default=480)
+parser.add_argument("-dfps", "--detection-fps", help="fast scene detection: candidate cuts are searched at this frame rate on downscaled frames, then exact cut frames are searched around them (0 to analyze every frame)", type=float, default=0)
+parser.add_argument("-dsf", "--detection-skip-frame", help="fast scene detection: frames not decoded while searching candidate cuts (noref: non-reference frames, nokey: all but keyframes)", choices=['none', 'noref', 'nokey'], default='none')
+parser.add_argument("-sdt", "--scene-detector", help="ffmpeg: scene filter of ffmpeg, scores: difference of piped low resolution frames computed in python, the scores are kept in --cache-dir so another --frame-diff-percentage never decodes the videos again", choices=['ffmpeg', 'scores'], default='ffmpeg')
+parser.add_argument("-ess", "--edge-scan-seconds", help="seconds at the beginning and end of videos scanned first to choose the safe pairs, the middle is scanned in the background (0 to scan the whole videos at once)", type=float, default=0)
+parser.add_argument("-tsw", "--twin-search-window", help="number of scenes around the expected position where a twin frame is searched (0 to search everywhere)", type=int, default=0)
+parser.add_argument("-ttw", "--twin-time-window", help="seconds around the time predicted by the safe start and end pairs where a twin frame is searched (0 to disable)", type=float, default=0)
+parser.add_argument("-ta", "--twin-alignment", help="greedy: nearest hash then removal of bad twins, dp: optimal monotonic alignment of the two scene sequences", choices=['greedy', 'dp'], default='greedy')
+parser.add_argument("-amd", "--alignment-max-distance", help="dp alignment: hamming distance from which two frames are never twins", type=int, default=10)
+parser.add_argument("-agp", "--alignment-gap-penalty", help="dp alignment: cost of a scene without twin", type=float, default=1)
+parser.add_argument("-ab", "--alignment-band", help="dp alignment: number of scenes around the diagonal that are considered (0 for all, automatic for huge inputs)", type=int, default=0)
+
+parser.add_argument("-b", "--batch", help="non-interactive run: safe pairs are chosen automatically, no prompt and no window is opened", action='store_true')
+parser.add_argument("-ass", "--anchor-search-seconds", help="batch mode: seconds at the beginning and end of videos where safe pairs are searched", type=float, default=300)
+parser.add_argument("-amxd", "--anchor-max-distance", help="batch mode: maximum hamming distance of a safe pair", type=int, default=6)
+parser.add_argument("-sf", "--status-file", help="batch mode: file where the json result of the run is written", default="")
+parser.add_argument("-alb", "--alignment-backend", help="'scenes' pairs the scene frames of the videos, 'audio' pairs windows of their audio (music and effects shared by source and target) without decoding any video frame", choices=['scenes', 'audio'], default='scenes')
+parser.add_argument("-aaw", "--audio-alignment-window", help="--alignment-backend audio: seconds of target audio matched at a time, a pair is found every half window", type=float, default=20)
+parser.add_argument("-aamo", "--audio-alignment-max-offset", help="--alignment-backend audio: seconds a window can move from the previous one (cut or added scenes)", type=float, default=60)
+parser.add_argument("-aamc", "--audio-alignment-min-correlation", help="--alignment-backend audio: windows with a lower correlation (from 0 to 1) give no pair", type=float, default=0.3)
+parser.add_argument("-sal", "--save-alignment", help="json file where scenes, pairs and time map are saved, it can be loaded by the audio and subs scripts (disabled if empty)", default="")
+parser.add_argument("-lal", "--load-alignment", help="json file saved with --save-alignment, scene detection and pair selection are skipped (disabled if empty)", default="")
+parser.add_argument("-wd", "--work-dir", help="folder for frames and preview files (default: current folder)", default="")
 
 parser.add_argument("-ff",  "--ffmpeg", help="ffmpeg binary path", default='ffmpeg')
 
@@ -237,21 +103,61 @@ ffmpeg_script = ARGS.ffmpeg
 
 source_path = ARGS.source_path
 target_path = ARGS.target_path
-source_sub_path = ARGS.source_sub_path
+source_sub_paths = ARGS.source_sub_path
+subtitle_workers = ARGS.subtitle_workers or os.cpu_count() or 1
 frame_diff_percentage = ARGS.frame_diff_percentage
+extraction_workers = ARGS.extraction_workers
+scene_segments = ARGS.scene_segments
+scene_segment_overlap = ARGS.scene_segment_overlap
+scene_segment_workers = ARGS.scene_segment_workers or scene_segments
+cache_dir = ARGS.cache_dir
+cache_max_bytes = ARGS.cache_max_mb * 1024 * 1024
+stream_hashes = ARGS.stream_hashes
+preview_width = ARGS.preview_width
+edge_scan_seconds = ARGS.edge_scan_seconds
+detection_fps = ARGS.detection_fps
+skip_frame = ARGS.detection_skip_frame
+scene_detector = ARGS.scene_detector
+twin_search_window = ARGS.twin_search_window
+twin_time_window = ARGS.twin_time_window
+twin_alignment = ARGS.twin_alignment
+alignment_max_distance = ARGS.alignment_max_distance
+alignment_gap_penalty = ARGS.alignment_gap_penalty
+alignment_band = ARGS.alignment_band
+batch_mode = ARGS.batch
+anchor_search_seconds = ARGS.anchor_search_seconds
+anchor_max_distance = ARGS.anchor_max_distance
+status_file = ARGS.status_file
+work_dir = ARGS.work_dir
+save_alignment_path = ARGS.save_alignment
+load_alignment_path = ARGS.load_alignment
+alignment_backend = ARGS.alignment_backend
+audio_alignment_window = ARGS.audio_alignment_window
+audio_alignment_max_offset = ARGS.audio_alignment_max_offset
+audio_alignment_min_correlation = ARGS.audio_alignment_min_correlation
 
 # Check if source_path and target_path are valid video files
 if not os.path.isfile(source_path):
-    print(f"The source video file '{source_path}' does not exist.")
-    sys.exit(1)
+    exit_with_error(f"The source video file '{source_path}' does not exist.")
 
 if not os.path.isfile(target_path):
-    print(f"The target video file '{target_path}' does not exist.")
-    sys.exit(1)
+    exit_with_error(f"The target video file '{target_path}' does not exist.")
+
+for source_sub_path in source_sub_paths:
+    if not os.path.isfile(source_sub_path) and not os.path.isdir(source_sub_path):
+        exit_with_error(f"The source subtitle file '{source_sub_path}' does not exist.")
+
+source_sub_paths = expand_subtitle_paths(source_sub_paths)
+if not source_sub_paths:
+    exit_with_error("No subtitle file found in the source subtitle folders.")
+
+if alignment_backend == 'audio' and (save_alignment_path or load_alignment_path):
+    exit_with_error("Alignment files keep scene frame pairs, --save-alignment and --load-alignment need --alignment-backend scenes.")
 
 # Define output folders for source and target frames
-source_frames_folder = "SOURCE_FRAMES"
-target_frames_folder = "TARGET_FRAMES"
+source_frames_folder = os.path.join(work_dir, "SOURCE_FRAMES")
+target_frames_folder = os.path.join(work_dir, "TARGET_FRAMES")
+pair_preview_path = os.path.join(work_dir, "test.html")
 
 source_video_folder = os.path.dirname(source_path)
 
@@ -263,172 +169,281 @@ os.makedirs(target_frames_folder, exist_ok=True)
 delete_frame_cache_files(source_frames_folder)
 delete_frame_cache_files(target_frames_folder)
 
+if cache_dir:
+    os.makedirs(cache_dir, exist_ok=True)
+
+# Probe both videos at the same time
+source_metadata, target_metadata = run_parallel(probe_video, [dict(video_path=source_path), dict(video_path=target_path)], max_workers=2)
+
 # Get FPS and TBN for the source video
-source_fps = get_fps(source_path)
-source_tbn = get_tbn(source_path)
+source_fps = source_metadata.fps
+source_tbn = source_metadata.tbn
 source_pos_per_frame = source_tbn / source_fps
-source_duration = get_duration(source_path)
+source_duration = source_metadata.duration
 
 print('source_duration', source_duration)
 
 # Get FPS and TBN for the target video
-target_fps = get_fps(target_path)
-target_tbn = get_tbn(target_path)
+target_fps = target_metadata.fps
+target_tbn = target_metadata.tbn
 target_pos_per_frame = target_tbn / target_fps
-target_duration = get_duration(target_path)
+target_duration = target_metadata.duration
 
 # Print the FPS and TBN for both videos
 print('')
 print(f"Source video - FPS: {source_fps}, TBN: {source_tbn}, PPF: {source_pos_per_frame}")
 print(f"Target video - FPS: {target_fps}, TBN: {target_tbn}, PPF: {target_pos_per_frame}", end="\n\n")
 
-# Run FFmpeg commands and capture frame information for both videos
-open_folder(source_frames_folder)
-source_frame_info = capture_frame_info(
-    video_path=source_path,
-    output_folder=source_frames_folder,
-    frame_diff=frame_diff_percentage,
-    video_tbn=source_tbn,
-    video_fps=source_fps,
-    video_pos_per_frame=source_pos_per_frame,
-    ffmpeg_script=ffmpeg_script
-)
-open_folder(target_frames_folder)
-target_frame_info = capture_frame_info(
-    video_path=target_path,
-    output_folder=target_frames_folder,
-    frame_diff=frame_diff_percentage,
-    video_tbn=target_tbn,
-    video_fps=target_fps,
-    video_pos_per_frame=target_pos_per_frame,
-    ffmpeg_script=ffmpeg_script
-)
-
-print('')
-# Prompt the user to input the start frame index for the source video
-source_start_frame = input("Check the {0} directory and enter the start frame number for the source video: ".format(source_frames_folder))
-# Prompt the user to input the start frame index for the target video
-target_start_frame = input("Check the {0} directory and enter the start frame number for the target video: ".format(target_frames_folder))
-
-# Convert the input values to integers
-source_start_frame = int(source_start_frame) - 1
-target_start_frame = int(target_start_frame) - 1
-
-print("Source video safe start frame infos:")
-describe_frame_infos(source_frame_info[source_start_frame])
-print("Target video safe start frame infos:")
-describe_frame_infos(target_frame_info[target_start_frame])
-print("Hamming distance between frames:")
-print(target_frame_info[target_start_frame]['hash'] - source_frame_info[source_start_frame]['hash'])
-print("\n")
-
-# Prompt the user to input the end frame index for the source video
-source_end_frame = input("Enter the end frame index for the source video: ")
-# Prompt the user to input the end frame index for the target video
-target_end_frame = input("Enter the end frame index for the target video: ")
-
-# Convert the input values to integers
-source_end_frame = int(source_end_frame) - 1
-target_end_frame = int(target_end_frame) - 1
-
-print("Source video safe end frame infos:")
-describe_frame_infos(source_frame_info[source_end_frame])
-print("Target video safe end frame infos:")
-describe_frame_infos(target_frame_info[target_end_frame])
-print("Hamming distance between frames:")
-print(target_frame_info[target_end_frame]['hash'] - source_frame_info[source_end_frame]['hash'])
-print("\n")
-
-if source_frame_info[source_end_frame]["scene_frame_index"] != source_end_frame or target_frame_info[target_end_frame]["scene_frame_index"] != target_end_frame:
-    print("SOMETHING IS WRONG WITH FRAME INDEXES!")
-    sys.exit(1)
-
-# Find twin frames
-twins = None
-if target_end_frame - target_start_frame < source_end_frame - source_start_frame:
-    twins = find_twin_frames(target_frame_info[target_start_frame:target_end_frame + 1], source_frame_info[source_start_frame:source_end_frame + 1], reverse_main_and_twin=True)
+if load_alignment_path:
+    # Scenes and pairs of a previous run, no scene detection
+    try:
+        alignment = load_alignment(load_alignment_path)
+    except (OSError, ValueError) as e:
+        exit_with_error(f"Cannot load the alignment file '{load_alignment_path}': {e}")
+    if not alignment_video_matches(alignment['source'], source_path) or not alignment_video_matches(alignment['target'], target_path):
+        exit_with_error(f"The alignment file '{load_alignment_path}' was made for other videos ({alignment['source']['path']}, {alignment['target']['path']}).")
+    source_frame_info = alignment_frame_infos(alignment['source']['scenes'])
+    target_frame_info = alignment_frame_infos(alignment['target']['scenes'])
+    twins = alignment['pairs']
+    source_start_frame, source_end_frame = alignment['source_anchors']
+    target_start_frame, target_end_frame = alignment['target_anchors']
+    print(f"Loaded {len(twins)} pairs from the alignment file '{load_alignment_path}'")
+elif alignment_backend == 'audio':
+    # Pairs of audio windows, no video frame is decoded
+    audio_pairs = find_audio_alignment(source_path, target_path, ffmpeg_script, source_duration, target_duration, audio_alignment_window, audio_alignment_max_offset, audio_alignment_min_correlation)
+    if len(audio_pairs) < 2:
+        exit_with_error("Less than 2 audio windows matched, try a smaller --audio-alignment-min-correlation or --alignment-backend scenes", 2)
+    print(f"Found {len(audio_pairs)} pairs of audio windows")
 else:
-    twins = find_twin_frames(source_frame_info[source_start_frame:source_end_frame + 1], target_frame_info[target_start_frame:target_end_frame + 1], reverse_main_and_twin=False)
-
-# Re-add manual inserted twins
-if twins[0]['main'] > source_start_frame: # if it was removed as a duplicate, re-add the manually provided safe start
-    twins.insert(0, {'main': source_start_frame, 'twin': target_start_frame, 'distance': 0})
-if twins[-1]['main'] < source_end_frame: # if it was removed as a duplicate, re-add the manually provided safe end
-    twins.append({'main': source_end_frame, 'twin': target_end_frame, 'distance': 0})
+    # Run FFmpeg commands and capture frame information for both videos
+    if not batch_mode:
+        open_folder(source_frames_folder)
+        open_folder(target_frames_folder)
+    (source_frame_info, source_scan_pending), (target_frame_info, target_scan_pending) = run_parallel(capture_frame_info, [
+        dict(
+            video_path=source_path,
+            output_folder=source_frames_folder,
+            frame_diff=frame_diff_percentage,
+            video_tbn=source_tbn,
+            video_fps=source_fps,
+            video_pos_per_frame=source_pos_per_frame,
+            ffmpeg_script=ffmpeg_script,
+            progress_label='source',
+            video_duration=source_duration,
+            segments=scene_segments,
+            segment_overlap=scene_segment_overlap,
+            segment_workers=scene_segment_workers,
+            cache_dir=cache_dir,
+            cache_max_bytes=cache_max_bytes,
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            edge_seconds=edge_scan_seconds,
+            detection_fps=detection_fps,
+            skip_frame=skip_frame,
+            scene_detector=scene_detector
+        ),
+        dict(
+            video_path=target_path,
+            output_folder=target_frames_folder,
+            frame_diff=frame_diff_percentage,
+            video_tbn=target_tbn,
+            video_fps=target_fps,
+            video_pos_per_frame=target_pos_per_frame,
+            ffmpeg_script=ffmpeg_script,
+            progress_label='target',
+            video_duration=target_duration,
+            segments=scene_segments,
+            segment_overlap=scene_segment_overlap,
+            segment_workers=scene_segment_workers,
+            cache_dir=cache_dir,
+            cache_max_bytes=cache_max_bytes,
+            stream_hashes=stream_hashes,
+            preview_width=preview_width,
+            edge_seconds=edge_scan_seconds,
+            detection_fps=detection_fps,
+            skip_frame=skip_frame,
+            scene_detector=scene_detector
+        )
+    ], max_workers=extraction_workers)
+
+    print('')
+    if batch_mode:
+        # Safe pairs are the most reliable matching frames near the beginning and the end of the videos
+        start_anchor, end_anchor = find_anchor_pairs(
+            source_frame_info['pts_s'], pack_hashes(source_frame_info),
+            target_frame_info['pts_s'], pack_hashes(target_frame_info),
+            anchor_search_seconds, anchor_max_distance
+        )
+        if start_anchor is None or end_anchor is None:
+            exit_with_error("No safe start and end frame pairs found, try a bigger --anchor-search-seconds or --anchor-max-distance", 2)
+        source_start_frame, target_start_frame, start_distance, start_confidence = start_anchor
+        source_end_frame, target_end_frame, end_distance, end_confidence = end_anchor
+        if source_end_frame <= source_start_frame or target_end_frame <= target_start_frame:
+            exit_with_error("Safe end frame pair found before the safe start one, try a smaller --anchor-search-seconds", 2)
+        print(f"Safe start pair: source {source_start_frame + 1}, target {target_start_frame + 1} (confidence {start_confidence:.2f})")
+        print(f"Safe end pair: source {source_end_frame + 1}, target {target_end_frame + 1} (confidence {end_confidence:.2f})")
+    else:
+        # Prompt the user to input the start frame index for the source video
+        source_start_frame = input("Check the {0} directory and enter the start frame number for the source video: ".format(source_frames_folder))
+        # Prompt the user to input the start frame index for the target video
+        target_start_frame = input("Check the {0} directory and enter the start frame number for the target video: ".format(target_frames_folder))
+
+        # Convert the input values to integers
+        source_start_frame = int(source_start_frame) - 1
+        target_start_frame = int(target_start_frame) - 1
+
+    print("Source video safe start frame infos:")
+    describe_frame_infos(source_frame_info[source_start_frame])
+    print("Target video safe start frame infos:")
+    describe_frame_infos(target_frame_info[target_start_frame])
+    print("Hamming distance between frames:")
+    print(frame_hash_distance(target_frame_info[target_start_frame], source_frame_info[source_start_frame]))
+    print("\n")
+
+    if not batch_mode:
+        # Prompt the user to input the end frame index for the source video
+        source_end_frame = input("Enter the end frame index for the source video: ")
+        # Prompt the user to input the end frame index for the target video
+        target_end_frame = input("Enter the end frame index for the target video: ")
+
+        # Convert the input values to integers
+        source_end_frame = int(source_end_frame) - 1
+        target_end_frame = int(target_end_frame) - 1
+
+    print("Source video safe end frame infos:")
+    describe_frame_infos(source_frame_info[source_end_frame])
+    print("Target video safe end frame infos:")
+    describe_frame_infos(target_frame_info[target_end_frame])
+    print("Hamming distance between frames:")
+    print(frame_hash_distance(target_frame_info[target_end_frame], source_frame_info[source_end_frame]))
+    print("\n")
+
+    if source_scan_pending is not None or target_scan_pending is not None:
+        # Safe pairs have been chosen on the edges, the frame indexes change once the middle scenes are added
+        print("Waiting for the scan of the middle of the videos...")
+        source_anchor_pts = [source_frame_info[source_start_frame]['pts'], source_frame_info[source_end_frame]['pts']]
+        target_anchor_pts = [target_frame_info[target_start_frame]['pts'], target_frame_info[target_end_frame]['pts']]
+        source_frame_info, target_frame_info = run_parallel(finish_capture_frame_info, [
+            dict(frame_info=source_frame_info, pending=source_scan_pending),
+            dict(frame_info=target_frame_info, pending=target_scan_pending)
+        ], max_workers=2)
+        source_start_frame, source_end_frame = [find_frame_info_index(source_frame_info, pts) for pts in source_anchor_pts]
+        target_start_frame, target_end_frame = [find_frame_info_index(target_frame_info, pts) for pts in target_anchor_pts]
+        print(f"Safe pairs in the whole videos: source {source_start_frame + 1}-{source_end_frame + 1}, target {target_start_frame + 1}-{target_end_frame + 1}")
+
+    if source_frame_info[source_end_frame]["scene_frame_index"] != source_end_frame or target_frame_info[target_end_frame]["scene_frame_index"] != target_end_frame:
+        exit_with_error("SOMETHING IS WRONG WITH FRAME INDEXES!")
+
+    # Find twin frames
+    twins = None
+    try:
+        if target_end_frame - target_start_frame < source_end_frame - source_start_frame:
+            twins = find_twin_frames(target_frame_info[target_start_frame:target_end_frame + 1], source_frame_info[source_start_frame:source_end_frame + 1], reverse_main_and_twin=True, search_window=twin_search_window, time_window=twin_time_window, alignment=twin_alignment, alignment_max_distance=alignment_max_distance, alignment_gap_penalty=alignment_gap_penalty, alignment_band=alignment_band)
+        else:
+            twins = find_twin_frames(source_frame_info[source_start_frame:source_end_frame + 1], target_frame_info[target_start_frame:target_end_frame + 1], reverse_main_and_twin=False, search_window=twin_search_window, time_window=twin_time_window, alignment=twin_alignment, alignment_max_distance=alignment_max_distance, alignment_gap_penalty=alignment_gap_penalty, alignment_band=alignment_band)
+    except ValueError as error:
+        exit_with_error(str(error))
+    if not twins:
+        exit_with_error("No twin frames matched between the safe start and end pairs, try another --twin-alignment, a bigger --twin-search-window/--twin-time-window or another --frame-diff-percentage.")
+
+    # Re-add manual inserted twins
+    if twins[0]['main'] > source_start_frame: # if it was removed as a duplicate, re-add the manually provided safe start
+        twins.insert(0, {'main': source_start_frame, 'twin': target_start_frame, 'distance': 0})
+    if twins[-1]['main'] < source_end_frame: # if it was removed as a duplicate, re-add the manually provided safe end
+        twins.append({'main': source_end_frame, 'twin': target_end_frame, 'distance': 0})
 
 # Timecodes
-timecodes = frame_index_to_timecodes(twins, source_frame_info, target_frame_info, source_fps, target_fps)
-
-# Build html to show pairs in the browser
-with open('test.html', 'w'):
-    pass
-with open('test.html', "a") as pair_preview_file:
-    for pair_index, pair in enumerate(twins):
-        old_time = timecodes[pair_index][0]
-        new_time = timecodes[pair_index][-1]
-        old_time_string = "{:02d}:{:02d}:{:02d}".format(int(math.floor(old_time / 3600)), int(math.floor(old_time / 60)), int(old_time % 60))
-        new_time_string = "{:02d}:{:02d}:{:02d}".format(int(math.floor(new_time / 3600)), int(math.floor(new_time / 60)), int(new_time % 60))
-
-        pair_preview_file.write('''
-        <div style="min-height: 450px;">
-            <h1>Association index {pair_index}</h1>
-            <img src="{source_frames_folder}/img{source_index:05d}.jpg" loading="lazy" style="width: 48%;">
-            <img src="{target_frames_folder}/img{target_index:05d}.jpg" loading="lazy" style="width: 48%;">
-            <p>{old_frame_index}frame {old_sample}sample ({old_time}) --> {new_sample}sample ({new_time})</p>
-        </div>
-        '''.format(
-            pair_index=pair_index,
-            source_frames_folder=source_frames_folder,
-            target_frames_folder=target_frames_folder,
-            source_index=pair['main'] + 1,
-            target_index=pair['twin'] + 1,
-            old_frame_index=source_frame_info[pair['main']]['index'],
-            old_sample=timecodes[pair_index][0],
-            new_sample=timecodes[pair_index][-1],
-            old_time=old_time_string,
-            new_time=new_time_string
-        ))
-
-# Open the html
-webbrowser.open('file://' + os.path.realpath('test.html'))
-
-# Manually remove bad indexes
-removing_twins = input("If you want to manually remove twins, write their index separated by comma (ex: '5,20'):\n")
-removing_indexes = removing_twins.split(',')
-int_numbers = []
-for num in removing_indexes:
-    try:
-        int_value = int(num)
-        int_numbers.append(int_value)
-    except ValueError:
-        pass
-sorted_numbers = sorted(int_numbers, reverse=True)
-for index in sorted_numbers:
-    print("Removing the pair with index {}".format(index))
-    twins.pop(index)
-    timecodes.pop(index)
+if alignment_backend == 'audio':
+    timecodes = [[source_second * 1000, target_second * 1000] for source_second, target_second, correlation in audio_pairs]
+elif load_alignment_path:
+    # seconds of the alignment file
+    timecodes = [[source_second * 1000, target_second * 1000] for source_second, target_second in alignment['time_map']]
+else:
+    timecodes = frame_index_to_timecodes(twins, source_frame_info, target_frame_info, source_fps, target_fps)
 
-# Initial timecode to cut off the beginning
-new_start_timecode = timecodes[0][0] - timecodes[0][1]
-timecodes.insert(0, [new_start_timecode, 1])
+if load_alignment_path:
+    removed_pair_indexes = set(alignment['removed_pairs'])
+else:
+    if alignment_backend == 'audio':
+        # no frame to show, the pairs are listed here
+        describe_audio_pairs(audio_pairs)
+    else:
+        # Build html to show pairs in the browser
+        with open(pair_preview_path, 'w'):
+            pass
+        with open(pair_preview_path, "a") as pair_preview_file:
+            for pair_index, pair in enumerate(twins):
+                old_time = timecodes[pair_index][0]
+                new_time = timecodes[pair_index][-1]
+                old_time_string = "{:02d}:{:02d}:{:02d}".format(int(math.floor(old_time / 3600)), int(math.floor(old_time / 60)), int(old_time % 60))
+                new_time_string = "{:02d}:{:02d}:{:02d}".format(int(math.floor(new_time / 3600)), int(math.floor(new_time / 60)), int(new_time % 60))
+
+                pair_preview_file.write('''
+                <div style="min-height: 450px;">
+                    <h1>Association index {pair_index}</h1>
+                    <img src="{source_frames_folder}/img{source_index:05d}.jpg" loading="lazy" style="width: 48%;">
+                    <img src="{target_frames_folder}/img{target_index:05d}.jpg" loading="lazy" style="width: 48%;">
+                    <p>{old_frame_index}frame {old_sample}sample ({old_time}) --> {new_sample}sample ({new_time})</p>
+                </div>
+                '''.format(
+                    pair_index=pair_index,
+                    source_frames_folder=os.path.basename(source_frames_folder),
+                    target_frames_folder=os.path.basename(target_frames_folder),
+                    source_index=pair['main'] + 1,
+                    target_index=pair['twin'] + 1,
+                    old_frame_index=source_frame_info[pair['main']]['index'],
+                    old_sample=timecodes[pair_index][0],
+                    new_sample=timecodes[pair_index][-1],
+                    old_time=old_time_string,
+                    new_time=new_time_string
+                ))
+
+        # Open the html
+        if not batch_mode:
+            webbrowser.open('file://' + os.path.realpath(pair_preview_path))
+
+    # Manually remove bad indexes
+    removing_twins = '' if batch_mode else input("If you want to manually remove twins, write their index separated by comma (ex: '5,20'):\n")
+    removed_pair_indexes = set(index for index in parse_pair_indexes(removing_twins) if 0 <= index < len(timecodes))
+pair_timecodes = timecodes
+
+if save_alignment_path:
+    save_alignment(save_alignment_path, source_path, target_path, source_frame_info, target_frame_info, twins, removed_pair_indexes, [source_start_frame, source_end_frame], [target_start_frame, target_end_frame])
+    print(f"Alignment saved in '{save_alignment_path}'")
+
+for index in sorted(removed_pair_indexes, reverse=True):
+    print("Removing the pair with index {}".format(index))
+timecodes = [pair for index, pair in enumerate(pair_timecodes) if index not in removed_pair_indexes]
+kept_pairs = len(timecodes)
 
-# Final timecode to keep the speed of the last safe segment until the end
-timecodes_last_index = len(timecodes) - 1
-last_safe_speed = (timecodes[timecodes_last_index][1] - timecodes[timecodes_last_index - 1][1]) / (timecodes[timecodes_last_index][0] - timecodes[timecodes_last_index - 1][0])
-source_end = source_duration * 1000 # sec to ms
-new_end = ((source_end - timecodes[timecodes_last_index][0]) * last_safe_speed) + timecodes[timecodes_last_index][1]
-timecodes.append([source_end - 1, new_end - 1])
+timecodes = complete_subtitle_timecodes(timecodes, source_duration)
 
 # Generate subtitles, force them to be srt
-output_sub_path = process_subtitles(source_sub_path, source_sub_path + '.srt', timecodes)
-
+output_sub_paths = process_subtitle_files(source_sub_paths, timecodes, max_workers=subtitle_workers)
 # Open folder with results
-open_folder(os.path.dirname(output_sub_path))
-print('The output file name is {output_sub_name}'.format(output_sub_name=os.path.basename(output_sub_path)))
-
-# Clean frame directories?
-clean_frame_dir = input("Do you want to clean frame directories? [Y/N]: ")
-
-if clean_frame_dir.lower() == 'y':
-    delete_frame_cache_files(source_frames_folder)
-    delete_frame_cache_files(target_frames_folder)
+if not batch_mode:
+    open_folder(os.path.dirname(output_sub_paths[0]))
+for output_sub_path in output_sub_paths:
+    print('The output file name is {output_sub_name}'.format(output_sub_name=os.path.basename(output_sub_path)))
+
+# Clean frame directories? (the audio backend makes none)
+if alignment_backend == 'scenes':
+    clean_frame_dir = 'y' if batch_mode else input("Do you want to clean frame directories? [Y/N]: ")
+
+    if clean_frame_dir.lower() == 'y':
+        delete_frame_cache_files(source_frames_folder)
+        delete_frame_cache_files(target_frames_folder)
+
+if batch_mode:
+    status = {
+        "status": "ok",
+        "exit_code": 0,
+        "output": output_sub_paths[0],
+        "outputs": output_sub_paths,
+        "pairs": kept_pairs
+    }
+    if alignment_backend == 'scenes':
+        # audio windows have no safe frame pairs
+        status["source_anchors"] = [source_start_frame + 1, source_end_frame + 1]
+        status["target_anchors"] = [target_start_frame + 1, target_end_frame + 1]
+    write_status(status_file, status)
@@ -6,7 +6,7 @@ a = Analysis(
     pathex=['..'],
     binaries=[],
     datas=[('../common/', 'common')],
-    hiddenimports=['common.utils'],
+    hiddenimports=['common.utils', 'common.scene_detection', 'common.scene_scores', 'common.frame_cache', 'common.frame_store', 'common.twin_matching', 'common.scene_capture', 'common.subtitles', 'common.alignment', 'common.audio_alignment'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
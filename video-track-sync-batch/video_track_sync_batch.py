@@ -0,0 +1,157 @@
+# Run the dynamic speed scripts on every pair of a manifest in --batch mode
+# manifest: csv with a "source,target,subtitle" header or json list of {"source": ..., "target": ..., "subtitle": ...}
+# subtitle is optional, it is retimed by the audio script with the pairs of the audio
+# rows sharing a target write their audio to <target>.<source name>.<ext> instead of <target>.<ext>
+
+import argparse
+import csv
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+if getattr(sys, 'frozen', False):
+    # The application is running in a bundled form created by PyInstaller
+    from common.utils import *
+else:
+    # The application is running in a normal Python environment
+    from utils import *
+
+SCRIPTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+AUDIO_SCRIPT = os.path.join(SCRIPTS_FOLDER, 'video-audio-track-sync-scenes-dynamic-speed', 'video_audio_track_sync_scenes_dynamic_speed.py')
+
+def read_manifest(manifest_path):
+    with open(manifest_path, 'r', newline='') as manifest_file:
+        if manifest_path.lower().endswith('.json'):
+            rows = json.load(manifest_file)
+        else:
+            rows = list(csv.DictReader(manifest_file))
+
+    # relative paths are relative to the manifest
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    for index, row in enumerate(rows):
+        job = {key: os.path.join(manifest_folder, row[key].strip()) if (row.get(key) or '').strip() else '' for key in ('source', 'target', 'subtitle')}
+        if not job['source'] or not job['target']:
+            print(f"Manifest row {index + 1} has no source or target, skipped")
+            continue
+        kind = 'audio_subs' if job['subtitle'] else 'audio'
+        job['id'] = '{:03d}_{}_{}'.format(index + 1, kind, os.path.splitext(os.path.basename(job['source']))[0])
+        jobs.append(job)
+
+    # the outputs are named after the target (audio) and the subtitle, jobs writing the same file are refused
+    target_counts = {}
+    for job in jobs:
+        target_counts[job['target']] = target_counts.get(job['target'], 0) + 1
+    output_jobs = {}
+    for job in jobs:
+        target_name = os.path.splitext(job['target'])[0]
+        job['output_prefix'] = target_name if target_counts[job['target']] == 1 else target_name + '.' + os.path.splitext(os.path.basename(job['source']))[0]
+        for output in [job['output_prefix']] + ([job['subtitle']] if job['subtitle'] else []):
+            if output in output_jobs:
+                sys.exit(f"Manifest jobs {output_jobs[output]} and {job['id']} write the same output '{output}'")
+            output_jobs[output] = job['id']
+    return jobs
+
+def split_extra_args(extra_args):
+    if os.name != 'nt':
+        return shlex.split(extra_args)
+    # the backslashes of windows paths are kept, only the quotes around an argument are removed
+    return [arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in '"\'' else arg for arg in shlex.split(extra_args, posix=False)]
+
+def load_results(results_path):
+    if not os.path.isfile(results_path):
+        return {}
+    with open(results_path, 'r') as results_file:
+        return json.load(results_file)
+
+def save_results(results_path, results):
+    # written to a temporary file first, an interrupted run never leaves a broken results file
+    with open(results_path + '.tmp', 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    os.replace(results_path + '.tmp', results_path)
+
+def run_job(job, work_root, extra_args):
+    job_folder = os.path.join(work_root, job['id'])
+    os.makedirs(job_folder, exist_ok=True)
+    status_path = os.path.join(job_folder, 'status.json')
+    if os.path.isfile(status_path):
+        os.remove(status_path)
+
+    command = [sys.executable, AUDIO_SCRIPT, '-sp', job['source'], '-tp', job['target'], '--output-prefix', job['output_prefix'], '--batch', '--work-dir', job_folder, '--status-file', status_path]
+    if job['subtitle']:
+        # same scene detection for the audio and the subtitle
+        command += ['-ssp', job['subtitle']]
+    command += extra_args
+
+    print(f"[{job['id']}] started")
+    with open(os.path.join(job_folder, 'log.txt'), 'w') as log_file:
+        # the script runs inside the job folder, nothing is shared with the other jobs
+        process = subprocess.run(command, cwd=job_folder, stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT)
+
+    if os.path.isfile(status_path):
+        with open(status_path, 'r') as status_file:
+            status = json.load(status_file)
+    else:
+        # crashed before writing its status
+        status = {"status": "error", "exit_code": process.returncode, "message": "no status written, see log.txt"}
+    print(f"[{job['id']}] {status['status']} (exit code {process.returncode})")
+    return status
+
+parser = argparse.ArgumentParser(description='Syncs the audio and the subtitles of all the pairs of a manifest')
+
+parser.add_argument("-m", "--manifest", help="csv or json file with source, target and optional subtitle paths", required=True)
+parser.add_argument("-wr", "--work-root", help="folder containing a work folder per job and the results file", default="BATCH")
+parser.add_argument("-j", "--jobs", help="number of pairs processed at the same time", type=int, default=2)
+parser.add_argument("-mp", "--max-processes", help="number of ffmpeg/rubberband processes running at the same time over all jobs (0 for no limit)", type=int, default=2)
+parser.add_argument("-rf", "--retry-failed", help="run again the jobs that failed in a previous run", action='store_true')
+parser.add_argument("-xa", "--extra-args", help="arguments added to every script call, quoted like in a shell (ex: --extra-args=\"-sh -cd 'MY CACHE'\")", default="")
+
+ARGS = parser.parse_args()
+
+work_root = os.path.abspath(ARGS.work_root)
+os.makedirs(work_root, exist_ok=True)
+results_path = os.path.join(work_root, 'results.json')
+
+if ARGS.max_processes > 0:
+    # the scripts started by the jobs take a slot of this folder before running ffmpeg or rubberband
+    slots_folder = os.path.join(work_root, 'SLOTS')
+    os.makedirs(slots_folder, exist_ok=True)
+    os.environ[PROCESS_SLOTS_DIR_ENV] = slots_folder
+    os.environ[PROCESS_SLOTS_ENV] = str(ARGS.max_processes)
+
+jobs = read_manifest(ARGS.manifest)
+extra_args = split_extra_args(ARGS.extra_args)
+results = load_results(results_path)
+results_lock = threading.Lock()
+
+# Completed jobs are never run again, failed ones only if asked
+pending_jobs = []
+for job in jobs:
+    previous = results.get(job['id'])
+    if previous and previous['status'] == 'ok':
+        print(f"[{job['id']}] already done, skipped")
+    elif previous and previous['status'] == 'error' and not ARGS.retry_failed:
+        print(f"[{job['id']}] failed in a previous run, skipped (use --retry-failed to run it again)")
+    else:
+        pending_jobs.append(job)
+
+def run_and_record(job):
+    status = run_job(job, work_root, extra_args)
+    with results_lock:
+        results[job['id']] = {**status, "source": job['source'], "target": job['target'], "subtitle": job['subtitle']}
+        save_results(results_path, results)
+    return status
+
+with ThreadPoolExecutor(max_workers=max(ARGS.jobs, 1)) as executor:
+    list(executor.map(run_and_record, pending_jobs))
+
+failed_jobs = [job['id'] for job in jobs if results.get(job['id'], {}).get('status') != 'ok']
+print(f"{len(jobs) - len(failed_jobs)}/{len(jobs)} jobs done, results in {results_path}")
+for job_id in failed_jobs:
+    print(f"Failed: {job_id} (see {os.path.join(work_root, job_id, 'log.txt')})")
+sys.exit(1 if failed_jobs else 0)